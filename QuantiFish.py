@@ -14,26 +14,99 @@ GNU General Public License for more details.
 You should have received a copy of the GNU General Public License
 along with this program. If not, see <http://www.gnu.org/licenses/>."""
 
+import argparse
+import copy
+import functools
+import importlib.util
+import io
+import math
+import multiprocessing
 import os
+import pickle
+import queue
+import secrets
+import socket
+import sqlite3
 import sys
 import threading
 import time
-import tkinter as tk
-import tkinter.filedialog as tkfiledialog
+import tracemalloc
+from collections import OrderedDict, deque
+from contextlib import contextmanager, nullcontext
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
 from csv import writer
-from tkinter import messagebox
-from tkinter import ttk
+from multiprocessing.connection import AuthenticationError, Client, Listener
 
 import numpy as np
-from PIL import Image, ImageTk
-from scipy.interpolate import interp1d
-from scipy.spatial import ConvexHull, qhull, distance_matrix, distance
-from skimage.feature import peak_local_max
-from skimage.measure import regionprops, label
-from skimage.transform import rescale
+from PIL import Image
+# scipy, skimage and pyarrow are slow to import, so they're imported by the functions using them to speed up startup.
+# pyarrow is optional, it's only needed for Parquet output.
+
+try:  # The UI is optional, analysis can run headless from the command line.
+    import tkinter as tk
+    import tkinter.filedialog as tkfiledialog
+    from tkinter import messagebox
+    from tkinter import ttk
+    from PIL import ImageTk
+except ImportError:
+    tk = None
 
 version = "2.1.2"
 
+# Parameters for different bit depths. (multiplier, maxrange)
+depthmap = {"8-bit": (1, 256), "10-bit": (4, 1024), "12-bit": (16, 4096), "16-bit": (256, 65536)}
+
+# Rows of an image to analyse at a time in low memory mode.
+lowmemoryrows = 1024
+
+# Pixels to threshold and reduce at a time, small enough for each chunk to stay in the CPU cache.
+chunkpixels = 2 ** 16
+
+# Buffered output is written to disk after this many rows or seconds, whichever comes first.
+flushrows = 1000
+flushinterval = 5
+
+# Foci per row group in Parquet output.
+parquetrows = 100000
+
+# Files to check the image type of at once when filtering by type, reading headers in parallel helps on network drives.
+scanthreads = 8
+
+# Records the time and memory used by each stage of analysis while profiling, see profiledanalysis.
+stagetimer = None
+
+# Milliseconds between checks for finished previews while one is being rendered.
+previewpoll = 30
+
+# Preview colours for positive pixels and for foci which would be counted.
+positivecolour = (0, 191, 255)
+focuscolour = (0, 75, 255)
+
+# Memory budget for preview images kept so files can be revisited without reading them again, in MB.
+previewcachemb = 512
+
+# Analysis backends. "numba" runs the thresholding and labelling hot loops as compiled kernels if numba is installed.
+backends = ("numpy", "numba")
+
+# Kernels compiled by numbakernel, by function.
+compiledkernels = {}
+
+# Smallest and largest grid analysis box sizes accepted.
+boxsizerange = (5, 999)
+
+# Name of the results cache kept in the output directory when reusing results from the main window.
+cachename = "quantifish_cache.db"
+
+# Port the coordinator accepts network workers on when started from the main window, see Coordinator.
+workerport = 47021
+
+# Files handed to a network worker at a time.
+unitfiles = 4
+
+# Seconds a network worker keeps trying to reach a coordinator which hasn't started yet.
+connectwait = 60
+
 
 # Get path for unpacked Pyinstaller exe (MEIPASS), else default to current directory.
 def resource_path(relative_path):
@@ -66,8 +139,7 @@ class CoreWindow:
             self.master.tk_setPalette(background='#E7E7E7', selectForeground='#ffffff', selectBackground='#0000ff')
 
         # Parameters for different display modes.
-        self.depthmap = {"8-bit": (1, 256), "10-bit": (4, 1024), "12-bit": (16, 4096), "16-bit": (256, 65536)}
-        # (ID, multiplier, maxrange)
+        self.depthmap = depthmap
         self.scalemultiplier, self.maxrange = self.depthmap["8-bit"]
         self.currentdepth = 8
         self.maxvalue = 0
@@ -88,6 +160,9 @@ class CoreWindow:
         self.imlrg = None  # Full size image in 8 bit depth for display
         self.imsml = None  # Resized image in 8 bit depth for display
         self.resizefactor = 1  # Factor to resize preview images by to fit window
+        self.previewimage = None  # PreviewImage currently displayed
+        self.renderer = PreviewRenderer(self.master)  # Renders previews away from the UI thread
+        self.previewcache = PreviewCache(previewcachemb)  # Recently previewed images
         self.previewfile = None  # Current preview file name
         self.currentpreviewfile = 0  # File list index of the current open preview file
         self.nooverlay = None  # Preview without overlay
@@ -108,6 +183,7 @@ class CoreWindow:
 
         # Threading Controllers
         self.list_stopper = threading.Event()
+        self.list_scanned = threading.Event()  # Set once the file list for a run has been fully scanned
 
         # Header Bar
         self.img = ImageTk.PhotoImage(Image.open(resource_path("resources/QFLogo")))
@@ -151,14 +227,36 @@ class CoreWindow:
         self.bitcheck['values'] = ('Auto Detect', '8-bit', '10-bit', '12-bit', '16-bit')
         self.bitcheck.current(0)
         self.bitcheck.bind("<<ComboboxSelected>>", self.bitmode_select)
+        self.prescan = tk.BooleanVar()
+        self.prescan.set(False)
+        self.prescancheck = ttk.Checkbutton(self.dirframe, text="Scan All Images", variable=self.prescan,
+                                            onvalue=True, offvalue=False, command=self.prescanstatus)
         self.subdiron = tk.BooleanVar()
         self.subdiron.set(True)
         self.subdircheck = ttk.Checkbutton(self.dirframe, text="Include Subdirectories", variable=self.subdiron,
                                            onvalue=True, offvalue=False, command=self.subtoggle)
-        self.currdir.grid(column=1, row=1, columnspan=5, sticky=tk.E + tk.W)
+        self.workers = tk.IntVar()
+        self.workers.set(1)
+        self.workerlabel = ttk.Label(self.dirframe, text="Processes:")
+        self.workerselect = ttk.Spinbox(self.dirframe, from_=1, to=os.cpu_count() or 1, textvariable=self.workers,
+                                        width=4, state="readonly", command=self.workerstatus)
+        self.networkworkers = tk.BooleanVar()
+        self.networkworkers.set(False)
+        self.networkcheck = ttk.Checkbutton(self.dirframe, text="Network Workers", variable=self.networkworkers,
+                                            onvalue=True, offvalue=False, command=self.networkstatus)
+        self.lowmemory = tk.BooleanVar()
+        self.lowmemory.set(False)
+        self.lowmemcheck = ttk.Checkbutton(self.dirframe, text="Low Memory Mode", variable=self.lowmemory,
+                                           onvalue=True, offvalue=False, command=self.lowmemstatus)
+        self.currdir.grid(column=1, row=1, columnspan=6, sticky=tk.E + tk.W)
         self.bitlabel.grid(column=1, row=2)
         self.bitcheck.grid(column=2, row=2)
-        self.subdircheck.grid(column=5, row=2, sticky=tk.E)
+        self.workerlabel.grid(column=3, row=2, padx=(10, 0))
+        self.workerselect.grid(column=4, row=2, sticky=tk.W)
+        self.lowmemcheck.grid(column=5, row=2, sticky=tk.E, padx=(0, 10))
+        self.subdircheck.grid(column=6, row=2, sticky=tk.E)
+        self.prescancheck.grid(column=1, row=3, columnspan=2, sticky=tk.W)
+        self.networkcheck.grid(column=3, row=3, columnspan=2, sticky=tk.W, padx=(10, 0))
         self.dirframe.grid(column=2, row=1, sticky=tk.NSEW, padx=5)
         self.dirframe.grid_columnconfigure(4, weight=1)
 
@@ -222,8 +320,8 @@ class CoreWindow:
         self.wantfluor50.set(False)
         self.wantspatial = tk.BooleanVar()
         self.wantspatial.set(False)
-        self.gridboxsize = tk.IntVar()
-        self.gridboxsize.set(50)
+        self.gridboxsize = tk.StringVar()  # One or more box sizes, separated by commas
+        self.gridboxsize.set("50")
         self.clusterbox = ttk.LabelFrame(self.corewrapper, relief=tk.GROOVE, text="Dissemination Analysis")
         self.cluscheck = ttk.Checkbutton(self.clusterbox, text="Analyse Foci",
                                          variable=self.clusteron,
@@ -240,7 +338,7 @@ class CoreWindow:
         self.setboxsizelabel = ttk.Label(self.clusterbox, text="Box Size:")
         self.boxsizevalidate = (self.clusterbox.register(self.validate_boxsize), '%P')
         self.setboxsize = ttk.Entry(self.clusterbox, textvariable=self.gridboxsize, validate='focusout',
-                                    validatecommand=self.boxsizevalidate, width=5, justify=tk.CENTER)
+                                    validatecommand=self.boxsizevalidate, width=8, justify=tk.CENTER)
 
         self.clustersavecheck = ttk.Checkbutton(self.clusterbox, text="Save foci data:",
                                                 variable=self.clustersave,
@@ -282,11 +380,21 @@ class CoreWindow:
         self.savefilenamebox = ttk.Entry(self.savefileframe, textvariable=self.savefilename, validate='focusout',
                                          validatecommand=self.savenamevalidate, width=8, justify=tk.CENTER)
         self.savefileextension = ttk.Label(self.savefileframe, text=".csv")
+        self.reuseresults = tk.BooleanVar()
+        self.reuseresults.set(False)
+        self.reusecheck = ttk.Checkbutton(self.savefileframe, text="Reuse Results", variable=self.reuseresults,
+                                          onvalue=True, offvalue=False, command=self.reusestatus)
+        self.recordtimings = tk.BooleanVar()
+        self.recordtimings.set(False)
+        self.timingscheck = ttk.Checkbutton(self.savefileframe, text="Record Timings", variable=self.recordtimings,
+                                            onvalue=True, offvalue=False, command=self.timingsstatus)
         self.saveselect.grid(column=1, row=4, sticky=tk.NSEW, padx=5)
 
         self.savefile.grid(column=1, row=1, columnspan=3, sticky=tk.NSEW, padx=5)
         self.savefilenamebox.grid(column=4, row=1)
         self.savefileextension.grid(column=5, row=1, sticky=tk.W, padx=(0, 10))
+        self.reusecheck.grid(column=6, row=1, sticky=tk.E)
+        self.timingscheck.grid(column=7, row=1, sticky=tk.E, padx=(10, 0))
 
         self.savefileframe.grid(column=2, row=4, sticky=tk.E + tk.W, padx=5)
         self.savefileframe.grid_columnconfigure(2, weight=1)
@@ -336,6 +444,7 @@ class CoreWindow:
                 self.logevent("Directory not changed")
                 return
             self.directory.set(newdirectory)
+            self.previewcache.clear()
             self.logevent("Images will be read from: " + str(newdirectory))
             self.dirstatus = True
             if self.dirstatus and self.savestatus:
@@ -373,6 +482,50 @@ class CoreWindow:
         else:
             self.logevent("Will skip images in subdirectories")
 
+    # Report change in number of analysis processes
+    def workerstatus(self):
+        if self.workers.get() > 1:
+            self.logevent("Will analyse images using %d processes" % self.workers.get())
+        else:
+            self.logevent("Will analyse images one at a time")
+
+    # Toggle handing images out to network workers
+    def networkstatus(self):
+        if self.networkworkers.get():
+            self.logevent("Images will be analysed by workers connecting over the network on port %d, the command "
+                          "to start them will be shown when analysis starts." % workerport)
+        else:
+            self.logevent("Images will be analysed on this computer.")
+
+    # Toggle detecting bit depth from every image
+    def prescanstatus(self):
+        if self.prescan.get():
+            self.logevent("When auto detecting, bit depth will be found from every image before analysis starts.")
+        else:
+            self.logevent("When auto detecting, bit depth will be found from the first image analysed.")
+
+    # Toggle reading images in bands
+    def lowmemstatus(self):
+        if self.lowmemory.get():
+            self.logevent("Images will be analysed in sections to reduce memory use.")
+        else:
+            self.logevent("Images will be loaded in full for analysis.")
+
+    # Toggle reuse of cached results
+    def reusestatus(self):
+        if self.reuseresults.get():
+            self.logevent("Results for unchanged images will be reused from previous runs.")
+        else:
+            self.logevent("All images will be analysed again.")
+
+    # Toggle recording of stage timings
+    def timingsstatus(self):
+        if self.recordtimings.get():
+            self.logevent("Time and memory used by each stage will be saved to %s_timings.csv. "
+                          "Analysis will be slower while recording." % self.savefilename.get())
+        else:
+            self.logevent("Stage timings will not be recorded.")
+
     # Open a file list window or refresh one that's open.
     def open_filelist_window(self):
         if self.file_list_window:
@@ -395,10 +548,11 @@ class CoreWindow:
         if self.dirstatus:
             self.open_filelist_window()
             self.filelist_contents.filelistlabel.config(text="Scanning, please wait...")
-            filelist = genfilelist(self.directory.get(), self.list_stopper)
-            for item in filelist:
+            filecount = 0
+            for item in iterfiles(self.directory.get(), self.get_settings(), self.list_stopper, self.logevent):
                 self.filelist_contents.filelistbox.insert(tk.END, str(item))
-            self.filelist_contents.filelistlabel.config(text=(str(len(filelist)) + " files to be analysed"))
+                filecount += 1
+            self.filelist_contents.filelistlabel.config(text=(str(filecount) + " files to be analysed"))
 
         else:
             self.logevent("No image directory set, unable to generate file list.")
@@ -499,7 +653,7 @@ class CoreWindow:
         if self.wantspatial.get():
             self.logevent("Spatial distribution analysis will be performed.")
             self.setboxsize.state(['!disabled'])
-            self.gridboxsize.set(50)
+            self.gridboxsize.set("50")
         else:
             self.logevent("Spatial analysis disabled.")
             self.setboxsize.state(['disabled'])
@@ -532,21 +686,21 @@ class CoreWindow:
             self.minarea.set(1)
             return False
 
-    # Restrict minimum area input to numbers only.
+    # Restrict box size input to numbers only, several sizes can be separated by commas.
     def validate_boxsize(self, newvalue):
         if newvalue in ("", "0"):
-            self.gridboxsize.set(5)
+            self.gridboxsize.set("5")
             return False
-        try:
-            if 4 < int(newvalue) < 1000:
+        # Every size is checked as typed, repeated sizes are fine and are dropped when the sizes are parsed.
+        sizes = newvalue.replace(",", " ").split()
+        if all(size.isdigit() for size in sizes):
+            if all(boxsizerange[0] <= int(size) <= boxsizerange[1] for size in sizes):
                 return True
-            else:
-                self.gridboxsize.set(50)
-                return False
-        except ValueError:
-            app.logevent("Box size out of acceptable range")
-            self.minarea.set(5)
+            self.gridboxsize.set("50")
             return False
+        app.logevent("Box size out of acceptable range")
+        self.gridboxsize.set("50")
+        return False
 
     # Restrict filename input to text only.
     def validate_text(self, newvalue, destination):
@@ -588,7 +742,7 @@ class CoreWindow:
     # Open preview window
     def openpreview(self):
         app.list_stopper.set()
-        self.filelist = genfilelist(self.directory.get(), app.list_stopper)
+        self.filelist = genfilelist(self.directory.get(), self.get_settings(), app.list_stopper, self.logevent)
         self.currentpreviewfile = 0
         try:
             if self.dirstatus:
@@ -602,73 +756,74 @@ class CoreWindow:
             self.logevent("Unable to open file, did you select a .tif image?")
             return
         self.logevent("Opening preview")
-        try:
-            self.genpreview(self.previewfile, False, True)
-            self.open_preview_window()
-            self.previewbutton.grid_forget()
-            self.refreshpreviewbutton.grid(column=1, row=5, sticky=tk.NSEW, padx=5)
-            if self.imagetypefail:
-                self.previewer_contents.previewpane.config(image='', text="[Preview Not Available]")
-                self.previewer_contents.previewpane.image = None
-        except (ValueError, TypeError, OSError, PermissionError, IOError):
-            self.logevent("Failed to generate preview, sorry!")
-
-    # Thresholded Preview Generator
-    def genpreview(self, tgt, wantclusters, newimage):
-        def previewclusters(imgarray, minimumarea):
-            clusterim = imgarray[:, :, 1].copy()
-            posmask = (clusterim > thold)
-            tmask2 = (clusterim < thold)
-            clusterim[tmask2] = 0
-            simpleclusters, numclusters = label(clusterim > 0, return_num=True)
-            areacounts = np.unique(simpleclusters, return_counts=True)
-            positivegroups = areacounts[0][1:][areacounts[1][1:] > minimumarea]
-            clustermask = np.isin(simpleclusters, positivegroups)
-            clusterim = imgarray.copy()
-            clusterim[posmask] = (0, 191, 255)
-            clusterim[clustermask] = (0, 75, 255)
-            if clusterim.shape[1] > 750:
-                self.resizefactor = 750 / clusterim.shape[1]
-                clusterim = rescale(clusterim, self.resizefactor, channel_axis=-1 if len(clusterim.shape) > 2 else None)
-                clusterim = (clusterim * 255).astype('uint8')
-            return clusterim
-
+        self.previewimage = self.preview = None
         self.imagetypefail = False
-        if newimage:
-            imfile, imagetype = open_file(tgt)
-            if imagetype == "Invalid":
-                self.imagetypefail = True
-                return
-            self.maxvalue = np.amax(imfile[:, :])
-            bit_depth_detect(imfile)
-            imfile = (imfile / app.scalemultiplier).astype('uint8')
-            im = imfile.copy()  # Clone file for work
-            # Reduce preview spawner to 8-bit range
-            if imfile.shape[1] > 750:
-                self.resizefactor = 750 / im.shape[1]
-                self.imsml = rescale(im, self.resizefactor, channel_axis=-1 if len(im.shape) > 2 else None)
-                self.imsml = (self.imsml * 255).astype('uint8')
+        self.open_preview_window()
+        self.previewbutton.grid_forget()
+        self.refreshpreviewbutton.grid(column=1, row=5, sticky=tk.NSEW, padx=5)
+        self.genpreview(False, True)
+
+    # Thresholded Preview Generator. Renders the current preview file in the background, loading it first if it's
+    # new, and shows the preview once it's ready. Replaces any preview still waiting to be rendered.
+    def genpreview(self, wantclusters, newimage):
+        settings = self.get_settings()
+        current = self.previewimage
+        file = self.previewfile
+        threshold = self.threshold.get()
+        minarea = self.minarea.get()
+        if not (wantclusters or newimage or current is None or current.file != file):
+            # Only the overlay palette needs to change, which is quick enough to do straight away.
+            self.renderer.cancel()
+            self.showpreview(current, None, threshold, False)
+            return
+
+        def render(checkstale):
+            image = current
+            if newimage or image is None or image.file != file:
+                image = self.previewcache.get(file, settings)
+            checkstale()
+            overlay = None
+            if image.imagetype != "Invalid":
+                overlay = renderoverlay(image, threshold, wantclusters, minarea, checkstale)
+            return image, overlay
+
+        self.renderer.submit(render, lambda result: self.showpreview(*result, threshold, wantclusters),
+                             lambda error: self.logevent("Error generating preview file"))
+
+    # Display a rendered preview, switching to its image if that's changed. Without a rendered overlay the image is
+    # shown with the threshold overlay palette.
+    def showpreview(self, image, overlay, threshold, wantclusters):
+        if not self.previewwindow:
+            return
+        if image is not self.previewimage:
+            self.previewimage = image
+            for message in image.messages:
+                self.logevent(message)
+            self.imagetypefail = image.imagetype == "Invalid"
+            if not self.imagetypefail:
+                self.currentchannel = image.channel
+                self.maxvalue = image.maxvalue
+                bit_depth_detect(self.maxvalue, self, lambda message: None)  # Already logged with the image.
+                self.imlrg, self.imsml, self.resizefactor = image.imlrg, image.imsml, image.resizefactor
+                self.nooverlay = ImageTk.PhotoImage(Image.fromarray(self.imsml))
+            self.prefetch_neighbours()
+        if not self.imagetypefail:
+            if overlay is None:
+                image.indexed.putpalette(overlaypalette(threshold))
+                self.previewrgb = image.indexed
             else:
-                self.imsml = im
-            self.imlrg = np.repeat(imfile[:, :, np.newaxis], 3, axis=2)  # Full size 256 array
-            self.imsml = np.repeat(self.imsml[:, :, np.newaxis], 3, axis=2)  # Scaled 256 array
-            nooverlay = Image.fromarray(self.imsml, 'RGB')
-            self.nooverlay = ImageTk.PhotoImage(nooverlay)
-        thold = self.threshold.get()
-        if not wantclusters:
-            im2 = self.imsml.copy()  # Clone the core image to work with it.
-            mask = (im2[:, :, 1] > thold)
-            im2[mask] = (0, 191, 255)
-        else:  # Clustering needed
-            try:  # Try running the full size image.
-                im2 = previewclusters(self.imlrg, self.minarea.get())
-            except MemoryError:  # Else revert to smaller preview
-                app.logevent("Insufficient memory to preview clusters, using reduced resolution (less accurate).")
-                newarea = self.minarea.get() * (self.resizefactor ** 2)
-                im2 = previewclusters(self.imsml, newarea)
-        self.previewrgb = Image.fromarray(im2, 'RGB')
-        self.preview = ImageTk.PhotoImage(self.previewrgb)
-        self.displayed = "overlay"
+                self.previewrgb = Image.fromarray(overlay, 'RGB')
+            self.preview = ImageTk.PhotoImage(self.previewrgb)
+            self.displayed = "clusters" if wantclusters else "overlay"
+        self.previewer_contents.display()
+
+    # Load the files either side of the current preview in the background, ready for Next/Previous File.
+    def prefetch_neighbours(self):
+        if not self.filelist or self.previewfile not in self.filelist:
+            return
+        index = self.filelist.index(self.previewfile)
+        neighbours = [self.filelist[i] for i in (index + 1, index - 1) if 0 <= i < len(self.filelist)]
+        self.previewcache.prefetch(neighbours, self.get_settings())
 
     # Trigger preview update if parameters changed.
     def preview_update(self, *args):
@@ -699,18 +854,30 @@ class CoreWindow:
             self.previewbutton.grid(column=1, row=5, sticky=tk.NSEW, padx=5)
             self.previewwindow.destroy()
             self.previewwindow = None
+            self.renderer.cancel()
+
+    # Snapshot the current analysis settings so they can be used away from the UI.
+    def get_settings(self):
+        boxsizes = parseboxsizes(self.gridboxsize.get()) or [50]
+        settings = AnalysisSettings(threshold=self.threshold.get(), filtermode=self.filtermode.get(),
+                                    channel=self.channelselect.get(), subdirectories=self.subdiron.get(),
+                                    keyword=self.textentry.get() if self.filterkwd.get() else None,
+                                    wantclusters=self.clusteron.get(),
+                                    minarea=self.minarea.get(), wantfluor50=self.wantfluor50.get(),
+                                    wantspatial=self.wantspatial.get(), gridboxsize=boxsizes[0],
+                                    extraboxsizes=tuple(boxsizes[1:]),
+                                    clustersave=self.clustersave.get(), workers=self.workers.get(),
+                                    tilerows=lowmemoryrows if self.lowmemory.get() else 0,
+                                    prescan=self.prescan.get())
+        settings.depthlocked = self.depthlocked
+        settings.tempdepthlock = self.tempdepthlock
+        settings.currentdepth = int(self.currentdepth)
+        settings.scalemultiplier, settings.maxrange = self.scalemultiplier, self.maxrange
+        return settings
 
     # Writes headers in output file
     def headers(self):
-        headings = ('File', 'Integrated Intensity', 'Positive Pixels', 'Maximum', 'Minimum', 'Stain Polygon Area')
-        if self.clusteron.get():
-            headings += ('Total Foci', 'Total Peaks', 'Large Foci', 'Peaks in Large Foci',
-                         'Integrated Intensity in Large Foci', 'Positive Pixels in Large Foci')
-            if app.wantfluor50.get():
-                headings += ('Fluor50',)
-            if app.wantspatial.get():
-                headings += ('Total Grid Boxes', 'Positive Grid Boxes', 'Focus Polygon Area', 'IFDmax')
-        headings += ('Displayed Threshold', 'Computed Threshold', 'Channel')
+        headings = mainheadings(self.get_settings())
         savefile = self.savedir.get() + '/' + self.savefilename.get() + '.csv'
         if os.path.isfile(savefile):
             if not messagebox.askokcancel("File Already Exists",
@@ -721,25 +888,9 @@ class CoreWindow:
             self.logevent("Output file created successfully")
         return True
 
-    # Exports data to csv file
-    def datawriter(self, exportpath, exportdata):
-        writeme = [exportpath, *exportdata, self.threshold.get(),
-                   self.threshold.get() * app.scalemultiplier,
-                   app.currentchannel]
-        try:
-            savefile = self.savedir.get() + '/' + self.savefilename.get() + '.csv'
-            with open(savefile, 'a', newline="\n", encoding="utf-8") as f:
-                writer(f).writerow(writeme)
-        except (OSError, PermissionError, IOError):
-            self.logevent("Unable to write to save file, please make sure it isn't open in another program!")
-
     # Writes headers needed in cluster analysis file
     def clusterheaders(self):
-        headings = (
-            'File', 'Focus ID', 'Focus Location', 'Focus Area', 'Maximum Intensity', 'Minimum Intensity',
-            'Average Intensity', 'Integrated Intensity')
-        if app.wantfluor50.get():
-            headings += ('Percent Intensity', 'Cumulative Intensity', 'Cumulative Percent Intensity')
+        headings = clusterheadings(self.get_settings())
         savefile = self.savedir.get() + '/' + self.clusfilename.get() + '.csv'
         if os.path.isfile(savefile):
             if not messagebox.askokcancel("File Already Exists",
@@ -750,15 +901,6 @@ class CoreWindow:
             self.logevent("Single focus output file created successfully")
         return True
 
-    # Exports data to csv file
-    def clusterwriter(self, exportdata):
-        savefile = self.savedir.get() + '/' + self.clusfilename.get() + '.csv'
-        try:
-            with open(savefile, 'a', newline="\n", encoding="utf-8") as f:
-                writer(f).writerows(exportdata)
-        except (OSError, PermissionError, IOError):
-            self.logevent("Unable to write to save file, please make sure it isn't open in another program!")
-
     # Script Starter
     def runscript(self):
         global mpro
@@ -797,7 +939,9 @@ class CoreWindow:
                        self.nofilter, self.greyonly, self.detect, self.channelselect, self.textfilter, self.textentry,
                        self.thrcheck, self.cluscheck, self.saveselect, self.savefile, self.savefilenamebox,
                        self.previewbutton, self.refreshpreviewbutton, self.fluorcheck, self.spatialcheck,
-                       self.setminsizelabel, self.setboxsizelabel, self.filetypelabel)
+                       self.setminsizelabel, self.setboxsizelabel, self.filetypelabel, self.workerlabel,
+                       self.workerselect, self.lowmemcheck, self.reusecheck,
+                       self.timingscheck, self.prescancheck, self.networkcheck)
         manualwidgets = (self.setthr, self.setarea, self.clusterfilenamebox, self.clustersavecheck, self.setboxsize)
         if self.locked:
             for widget in listwidgets:
@@ -830,7 +974,8 @@ class CoreWindow:
         self.progress_var.set(self.progress_var.get() + 1)
         self.progress_text.set('File %(fileid)02d of %(totalfiles)02d' % {'fileid': self.progress_var.get(),
                                                                           'totalfiles': self.listlength})
-        if self.listlength == self.progress_var.get():
+        # The file list is still growing until the scan finishes, so analysis can catch up with it mid-run.
+        if self.listlength == self.progress_var.get() and self.list_scanned.is_set():
             self.progress_text.set('Completed analysis of %(totalfiles)02d files' % {'totalfiles': self.listlength})
         return
 
@@ -849,121 +994,1352 @@ class CoreWindow:
 
 
 # File List Generator
-def genfilelist(tgtdirectory, aborter):
-    subdirectories = app.subdiron.get()
-    searchmode = app.filtermode.get()
-    if app.filterkwd.get():
-        kwd = app.textentry.get()
-        filelist = [os.path.normpath(os.path.join(root, f)) for root, dirs, files in os.walk(tgtdirectory) for f in
-                    files if f.lower().endswith((".tif", ".tiff")) and not f.startswith(".") and kwd in f and (
-                            root == tgtdirectory or subdirectories)]
-    else:  # No keyword filter
-        filelist = [os.path.normpath(os.path.join(root, f)) for root, dirs, files in os.walk(tgtdirectory) for f in
-                    files if f.lower().endswith((".tif", ".tiff")) and not f.startswith(".") and (
-                            root == tgtdirectory or subdirectories)]
-    if searchmode == 1:  # Greyscale Only
-        allowed_formats = ("I", "F", "L")
-    elif searchmode == 2:  # RGB Only
-        allowed_formats = ("RGB", "RGBA")
-    else:  # No type filter, return.
-        app.list_stopper.clear()
-        return filelist
-    filteredfilelist = []
-    for file in filelist:  # Remove files in incorrect format.
-        if aborter.is_set():
-            try:
-                imgtest = Image.open(file)
-                if imgtest.mode.startswith(allowed_formats):
-                    filteredfilelist.append(file)
-                imgtest.close()
-            except (OSError, PermissionError, IOError):
-                app.logevent("ERROR: Unable to read " + file)
-                app.logevent("File may be corrupted. Will skip during analysis.")
-    app.list_stopper.clear()
-    return filteredfilelist
+def genfilelist(tgtdirectory, settings, aborter, log):
+    return list(iterfiles(tgtdirectory, settings, aborter, log))
+
+
+# Find images to analyse, yielding them as they're found. Runs until the directory has been scanned or the aborter is
+# cleared, then clears the aborter. Image types are checked from file headers several files at a time.
+def iterfiles(tgtdirectory, settings, aborter, log):
+    searchmode = settings.filtermode
+    files = scandirectory(tgtdirectory, settings)
+    try:
+        if searchmode == 0:  # No type filter
+            for file in files:
+                if not aborter.is_set():
+                    return
+                yield file
+            return
+        if searchmode == 1:  # Greyscale Only
+            allowed_formats = ("I", "F", "L")
+        else:  # RGB Only
+            allowed_formats = ("RGB", "RGBA")
+        checker = ThreadPoolExecutor(max_workers=scanthreads)
+        pending = deque()  # Type checks in scan order
+        try:
+            for file in files:
+                if not aborter.is_set():
+                    return
+                pending.append((file, checker.submit(imagemode, file)))
+                while pending and (pending[0][1].done() or len(pending) >= scanthreads * 4):
+                    yield from checkmode(*pending.popleft(), allowed_formats, log)
+            while pending and aborter.is_set():
+                yield from checkmode(*pending.popleft(), allowed_formats, log)
+        finally:
+            checker.shutdown(wait=False, cancel_futures=True)
+    finally:
+        aborter.clear()
+
+
+# Walk a directory for .tif files in the same order as os.walk, only entering subdirectories if they're wanted.
+def scandirectory(directory, settings):
+    subdirectories = []
+    try:
+        with os.scandir(directory) as entries:
+            entries = list(entries)
+    except OSError:
+        return
+    for entry in entries:
+        try:
+            isdirectory = entry.is_dir()
+        except OSError:
+            isdirectory = False
+        if isdirectory:
+            if settings.subdirectories and not entry.is_symlink():
+                subdirectories.append(entry.path)
+        elif entry.name.lower().endswith((".tif", ".tiff")) and not entry.name.startswith(".") and (
+                settings.keyword is None or settings.keyword in entry.name):
+            yield os.path.normpath(entry.path)
+    for subdirectory in subdirectories:
+        yield from scandirectory(subdirectory, settings)
+
+
+# Image mode from a file's header, None if it can't be read.
+def imagemode(file):
+    try:
+        with openheader(file) as imgtest:
+            return imgtest.mode
+    except (OSError, PermissionError, IOError, Image.DecompressionBombError):
+        return None
+
+
+# Yield a file if its image type check passed, logging files which couldn't be read.
+def checkmode(file, check, allowed_formats, log):
+    mode = check.result()
+    if mode is None:
+        log("ERROR: Unable to read " + file)
+        log("File may be corrupted. Will skip during analysis.")
+    elif mode.startswith(allowed_formats):
+        yield file
+
+
+# Scan for images on a background thread, so the full list builds up while the first files are being analysed.
+# Yields files as they're found, and adds them to filelist. The scanned event is set once filelist is complete.
+def streamfiles(tgtdirectory, settings, aborter, log, filelist, scanned=None):
+    found = queue.Queue()
+
+    def scan():
+        try:
+            for file in iterfiles(tgtdirectory, settings, aborter, log):
+                filelist.append(file)
+                found.put(file)
+        finally:
+            if scanned is not None:
+                scanned.set()
+            found.put(None)
+
+    scanner = threading.Thread(target=scan, daemon=True)
+    scanner.start()
+    try:
+        while True:
+            file = found.get()
+            if file is None:
+                return
+            yield file
+    finally:
+        aborter.clear()  # Stop scanning if analysis finishes early.
+
+
+# Snapshot of the analysis settings. Holds plain values only so it can be sent to worker processes.
+class AnalysisSettings:
+    def __init__(self, threshold=60, filtermode=0, channel="Detect", subdirectories=True, keyword=None,
+                 bitdepth=None, wantclusters=False, minarea=1, wantfluor50=False, wantspatial=False, gridboxsize=50,
+                 extraboxsizes=(),
+                 clustersave=False, workers=1, tilerows=0, prefetch=2, prefetchmemory=512, prescan=False,
+                 backend="numpy"):
+        self.threshold = threshold  # Threshold on the displayed 0-256 scale
+        self.filtermode = filtermode  # File filter mode: None, Greyscale, RGB
+        self.channel = channel  # Channel to analyse in RGB images
+        self.subdirectories = subdirectories  # Include images in subdirectories?
+        self.keyword = keyword  # Only analyse files with this in their name
+        self.wantclusters = wantclusters  # Run foci analysis?
+        self.minarea = minarea  # Minimum focus size
+        self.wantfluor50 = wantfluor50  # Calculate Fluor50?
+        self.wantspatial = wantspatial  # Run spatial analysis?
+        self.gridboxsize = gridboxsize  # Box size for grid analysis
+        self.extraboxsizes = tuple(extraboxsizes)  # Further box sizes to run grid analysis with
+        self.clustersave = clustersave  # Keep per-focus data for the foci file?
+        self.workers = workers  # Number of processes to analyse images with
+        self.tilerows = tilerows  # Rows per band in low memory mode, 0 to load whole images
+        self.prefetch = prefetch  # Files to read ahead while analysing in a single process
+        self.prefetchmemory = prefetchmemory  # Memory limit for images read ahead, in MB
+        self.prescan = prescan  # Detect the bit depth from every image before analysis, see prescandepth
+        self.backend = backend  # Backend for the hot loops of analysis, one of backends
+        # Bit depth state, mirrors that of the core window. Detected from the first image unless specified.
+        self.depthlocked = bitdepth is not None
+        self.tempdepthlock = False
+        self.currentdepth = int(bitdepth.split("-")[0]) if bitdepth else 8
+        self.scalemultiplier, self.maxrange = depthmap[bitdepth or "8-bit"]
 
 
 # Master File Cycler
 def cyclefiles(stopper, tgtdirectory):
+    settings = app.get_settings()
     app.progress_var.set(0)
     app.list_stopper.set()
-    thresh = app.threshold.get() * app.scalemultiplier
-    app.filelist = genfilelist(tgtdirectory, app.list_stopper)
-    for file in app.filelist:
-        if stopper.is_set():
-            app.increment_progress()
-            app.logevent("Analysing: " + file)
-            imagedata, filetype = open_file(file)
-            if filetype == "Invalid":
-                app.logevent("Invalid file type, analysis skipped")
-            else:
-                if not app.depthlocked and not app.tempdepthlock:
-                    thresh = app.threshold.get() * app.scalemultiplier
-                    app.tempdepthlock = True
+    app.filelist = []
+    app.list_scanned.clear()
+    files = streamfiles(tgtdirectory, settings, app.list_stopper, app.logevent, app.filelist, app.list_scanned)
+    resultsink = clustersink = cache = profiler = coordinator = None
+    try:
+        resultsink = CSVSink(app.savedir.get() + '/' + app.savefilename.get() + '.csv', app.logevent)
+        if settings.wantclusters and settings.clustersave:
+            clustersink = CSVSink(app.savedir.get() + '/' + app.clusfilename.get() + '.csv', app.logevent)
+        if app.reuseresults.get():
+            cache = ResultsCache(app.savedir.get() + '/' + cachename)
+        if app.recordtimings.get():
+            profiler = Profiler(app.savedir.get() + '/' + app.savefilename.get() + '_timings.csv', app.logevent)
+    except (OSError, PermissionError, IOError, sqlite3.Error):
+        app.logevent("Unable to write to save file, please make sure it isn't open in another program!")
+        stopper.clear()
+    else:
+        # The sinks log their own write errors, so only problems with the results cache can stop the run from here.
+        try:
+            if app.networkworkers.get():
                 try:
-                    results = genstats(imagedata, thresh, app.clusteron.get(), file)
-                    app.datawriter(file, results)
-                except (AttributeError, ValueError, TypeError, OSError, PermissionError, IOError):
-                    app.logevent("Analysis failed, image may be corrupted. Please report this!")
-        else:
-            app.progress_var.set(app.listlength)
-            app.progress_text.set('Analysis Aborted')
+                    coordinator = servecoordinator(("", workerport), None, app.logevent)
+                except OSError:
+                    app.logevent("Unable to accept network workers on port %d, analysis aborted. Is another copy "
+                                 "of QuantiFish using it?" % workerport)
+                    stopper.clear()
+            if settings.prescan:
+                files = list(files)
+                prescandepth(files, settings, stopper, cache, app.logevent)
+            for file, (imagetype, channel, results, clusterdata, messages) in iteranalysis(files, settings, stopper,
+                                                                                           cache, profiler=profiler,
+                                                                                           coordinator=coordinator):
+                app.increment_progress()
+                app.logevent("Analysing: " + file)
+                for message in messages:
+                    app.logevent(message)
+                if results is not None:
+                    app.currentchannel = channel
+                    with writertimer(profiler, file, "datawriter"):
+                        resultsink.writerow(datarow(file, results, settings, channel))
+                    if clusterdata:
+                        with writertimer(profiler, file, "clusterwriter"):
+                            clustersink.writerows(clusterdata)
+        except sqlite3.Error:
+            app.logevent("Unable to use the results cache, analysis aborted. Please make sure %s isn't open in "
+                         "another program!" % cachename)
+            stopper.clear()
+    finally:
+        for sink in (resultsink, clustersink, cache, profiler, coordinator):
+            if sink:
+                sink.close()
+    if profiler:
+        app.logevent("Time spent in each stage:")
+        for line in profiler.summary():
+            app.logevent(line)
+    if not stopper.is_set():
+        app.progress_var.set(app.listlength)
+        app.progress_text.set('Analysis Aborted')
+    else:  # The scan may have finished after the last file was analysed.
+        app.listlength = len(app.filelist)
+        app.progressbar.config(maximum=app.listlength)
+        app.progress_var.set(app.listlength)
+        app.progress_text.set('Completed analysis of %(totalfiles)02d files' % {'totalfiles': app.listlength})
     app.ui_lock()
+    app.tempdepthlock = settings.tempdepthlock
     if app.bitcheck.current() == 0:
         bit_depth_reset()
 
     app.logevent("Analysis Complete!")
 
 
+# Run a full batch without the UI, writing results to csv. Returns the number of images analysed. Results are reused
+# from and saved to the cache file if one is given. Stage timings are saved to the timings file if one is given. Images
+# are analysed by network workers connecting to the serve address (host, port) if one is given, see Coordinator.
+def runbatch(tgtdirectory, outputfile, settings, clusterfile=None, log=print, stopper=None, cachefile=None,
+             timingsfile=None, serve=None, authkey=None):
+    if settings.wantclusters and settings.clustersave and not clusterfile:
+        raise ValueError("A foci output file is needed to save foci data")
+    parquet = clusterfile is not None and clusterfile.lower().endswith(".parquet")
+    if parquet and importlib.util.find_spec("pyarrow") is None:
+        raise ValueError("Parquet output requires pyarrow to be installed")
+    if stopper is None:
+        stopper = threading.Event()
+        stopper.set()
+    lister = threading.Event()
+    lister.set()
+    filelist = []
+    files = streamfiles(tgtdirectory, settings, lister, log, filelist)
+    analysed = 0
+    with CSVSink(outputfile, headings=mainheadings(settings)) as resultsink:
+        clustersink = cache = profiler = coordinator = None
+        if settings.wantclusters and settings.clustersave:
+            if parquet:
+                clustersink = ParquetSink(clusterfile, settings)
+            else:
+                clustersink = CSVSink(clusterfile, headings=clusterheadings(settings))
+        try:
+            if cachefile:
+                cache = ResultsCache(cachefile)
+            if timingsfile:
+                profiler = Profiler(timingsfile)
+            if serve:
+                coordinator = servecoordinator(serve, authkey, log)
+            if settings.prescan:
+                files = list(files)
+                prescandepth(files, settings, stopper, cache, log)
+            for file, (imagetype, channel, results, clusterdata, messages) in iteranalysis(files, settings, stopper,
+                                                                                           cache, profiler=profiler,
+                                                                                           coordinator=coordinator):
+                log("Analysing: " + file)
+                for message in messages:
+                    log(message)
+                if results is not None:
+                    analysed += 1
+                    with writertimer(profiler, file, "datawriter"):
+                        resultsink.writerow(datarow(file, results, settings, channel))
+                    if clusterdata:
+                        with writertimer(profiler, file, "clusterwriter"):
+                            clustersink.writerows(clusterdata)
+        finally:
+            for sink in (clustersink, cache, profiler, coordinator):
+                if sink:
+                    sink.close()
+    if not stopper.is_set():
+        log("Analysis Aborted")
+    if profiler:
+        log("Time spent in each stage:")
+        for line in profiler.summary():
+            log(line)
+    log("Analysis Complete! %d of %d files analysed" % (analysed, len(filelist)))
+    return analysed
+
+
+# Measure every image in a directory at many thresholds in a single pass, writing one row per image and threshold.
+# Thresholds are on the displayed 0-256 scale. Returns the number of images analysed. Images are measured by network
+# workers connecting to the serve address if one is given, as in runbatch.
+def runsweep(tgtdirectory, outputfile, settings, thresholds, log=print, stopper=None, serve=None, authkey=None):
+    if stopper is None:
+        stopper = threading.Event()
+        stopper.set()
+    lister = threading.Event()
+    lister.set()
+    filelist = []
+    files = streamfiles(tgtdirectory, settings, lister, log, filelist)
+    log("Measuring images at %d thresholds" % len(thresholds))
+    if settings.prescan:
+        files = list(files)
+        prescandepth(files, settings, stopper, None, log)
+    analysed = 0
+    analyser = functools.partial(sweep_file, thresholds=list(thresholds))
+    headings = ('File', 'Displayed Threshold', 'Computed Threshold', 'Integrated Intensity', 'Positive Pixels',
+                'Maximum', 'Minimum', 'Channel')
+    with CSVSink(outputfile, headings=headings) as resultsink, \
+            (servecoordinator(serve, authkey, log) if serve else nullcontext()) as coordinator:
+        for file, (imagetype, channel, results, clusterdata, messages) in iteranalysis(files, settings, stopper,
+                                                                                       analyser=analyser,
+                                                                                       coordinator=coordinator):
+            log("Analysing: " + file)
+            for message in messages:
+                log(message)
+            if results is not None:
+                analysed += 1
+                max_value, min_value, measurements = results
+                resultsink.writerows([file, threshold, threshold * settings.scalemultiplier, intint, count, max_value,
+                                      min_value, channel] for threshold, (intint, count) in zip(thresholds,
+                                                                                                measurements))
+    if not stopper.is_set():
+        log("Analysis Aborted")
+    log("Threshold sweep complete! %d of %d files analysed" % (analysed, len(filelist)))
+    return analysed
+
+
+# Analyse files in list order, yielding results as they become available. Uses a process pool if requested and
+# reuses results from the cache for unchanged files if one is given. Files are analysed with analyse_file unless
+# another analyser with the same signature is given. Stage timings are recorded by the profiler if one is given.
+# Files are handed out to network workers instead if a coordinator is given.
+def iteranalysis(filelist, settings, stopper, cache=None, analyser=None, profiler=None, coordinator=None):
+    analyser = analyser or analyse_file
+    if profiler is None:
+        yield from analysisjobs(iter(filelist), settings, stopper, cache, analyser, True, coordinator)
+        return
+    # Read ahead isn't used while profiling so that reading each file is timed.
+    analyser = functools.partial(profiledanalysis, analyser, Profiler.record)
+    for file, result in analysisjobs(iter(filelist), settings, stopper, cache, analyser, False, coordinator):
+        yield file, profiler.collect(file, result)
+
+
+# Run the analyser over files for iteranalysis, serially, reading ahead, in a process pool or on network workers as
+# settings require.
+def analysisjobs(files, settings, stopper, cache, analyser, readahead, coordinator=None):
+    if coordinator is not None:
+        yield from distributedanalysis(files, settings, stopper, cache, analyser, coordinator)
+        return
+    if settings.workers <= 1:
+        if settings.prefetch and not settings.tilerows and readahead:
+            yield from prefetchanalysis(files, settings, stopper, cache, analyser)
+            return
+        for file in files:
+            if not stopper.is_set():
+                return
+            yield file, cachedanalysis(file, settings, cache, analyser)
+        return
+    # The first valid image sets the bit depth for the run, so work serially until depth is locked.
+    if not settings.depthlocked and not settings.tempdepthlock:
+        for file in files:
+            if not stopper.is_set():
+                return
+            yield file, cachedanalysis(file, settings, cache, analyser)
+            if settings.tempdepthlock:
+                break
+    pool = ProcessPoolExecutor(max_workers=settings.workers, mp_context=multiprocessing.get_context("spawn"))
+    pending = deque()  # Submitted jobs in file list order, with the cache key to store their results under
+
+    # Collect the oldest job, caching its results.
+    def collect():
+        file, key, job = pending.popleft()
+        result = job.result()
+        if key is not None:
+            cache.store(key, settings, result)
+        return file, result
+
+    try:
+        for file in files:
+            if not stopper.is_set():
+                return
+            pendingfile = file
+            key = cache.key(file, settings) if cache else None
+            result = cache.fetch(key, file, settings) if cache else None
+            if result is None:
+                job = pool.submit(analyser, file, settings)
+            else:  # Already analysed, queue the cached results so they're still handed back in order.
+                job = Future()
+                job.set_result(result)
+                key = None
+            pending.append((file, key, job))
+            # Keep a few jobs queued per worker, yield the oldest once the queue is full.
+            if len(pending) >= settings.workers * 2:
+                pendingfile = pending[0][0]
+                yield collect()
+        while pending:
+            if not stopper.is_set():
+                return
+            pendingfile = pending[0][0]
+            yield collect()
+    except BrokenProcessPool:
+        stopper.clear()
+        yield pendingfile, ("Invalid", None, None, None, ["A worker process crashed, analysis aborted. "
+                                                          "Try using fewer processes."])
+    finally:
+        # Wait for the workers to exit once all jobs are done, otherwise the pool can still be tearing down when the
+        # interpreter exits ("Bad file descriptor"). Aborted runs don't wait, so stopping a run doesn't hang.
+        pool.shutdown(wait=not pending, cancel_futures=True)
+
+
+# Analyse files one at a time, reading upcoming files on a background thread so that reading overlaps with analysis.
+# Up to settings.prefetch files are read ahead, fewer if they take up more than settings.prefetchmemory MB. Nothing is
+# read ahead until the bit depth is locked, so cached results are looked up with the same depth as a normal run.
+def prefetchanalysis(files, settings, stopper, cache, analyser):
+    reader = ThreadPoolExecutor(max_workers=1)
+    pending = deque()  # Files in list order with their cache key, and cached results or the job reading them
+
+    # Analyse the oldest file, caching its results.
+    def collect():
+        file, key, result, job = pending.popleft()
+        if result is None:
+            result = analyser(file, settings, loaded=job.result())
+            if cache is not None:
+                cache.store(key, settings, result)
+        return file, result
+
+    # Memory used by images which have been read but not analysed yet.
+    def prefetched():
+        return sum(imagebytes(job.result()[0]) for file, key, result, job in pending
+                   if job is not None and job.done() and job.exception() is None)
+
+    try:
+        for file in files:
+            if not stopper.is_set():
+                return
+            key = cache.key(file, settings) if cache else None
+            result = cache.fetch(key, file, settings) if cache else None
+            job = reader.submit(load_file, file, settings) if result is None else None
+            pending.append((file, key, result, job))
+            while pending and (not (settings.depthlocked or settings.tempdepthlock) or
+                               len(pending) > settings.prefetch or prefetched() > settings.prefetchmemory * 2 ** 20):
+                yield collect()
+                if not stopper.is_set():
+                    return
+        while pending:
+            if not stopper.is_set():
+                return
+            yield collect()
+    finally:
+        reader.shutdown(wait=False, cancel_futures=True)
+
+
+# Analyse files on network workers connected to the coordinator, yielding results in list order. Files are sent out
+# in units of unitfiles, with cached results used for unchanged files. As with a process pool, the first valid image
+# is analysed here to set the bit depth that the workers then use.
+def distributedanalysis(files, settings, stopper, cache, analyser, coordinator):
+    if not settings.depthlocked and not settings.tempdepthlock:
+        for file in files:
+            if not stopper.is_set():
+                return
+            yield file, cachedanalysis(file, settings, cache, analyser)
+            if settings.tempdepthlock:
+                break
+    pending = deque()  # Files in list order with their cache key, and cached results or the unit they were sent in
+    finished = {}  # Results of units handed back by workers, by unit index
+    unit = []
+    units = 0
+
+    # Results for the oldest file, caching them.
+    def collect():
+        file, key, result, index = pending.popleft()
+        if result is None:
+            result = finished[index].popleft()
+            if not finished[index]:
+                del finished[index]
+            if key is not None:
+                cache.store(key, settings, result)
+        return file, result
+
+    # Whether results for the oldest file are in.
+    def ready():
+        file, key, result, index = pending[0]
+        return result is not None or index in finished
+
+    for file in files:
+        if not stopper.is_set():
+            return
+        key = cache.key(file, settings) if cache else None
+        result = cache.fetch(key, file, settings) if cache else None
+        pending.append((file, key, result, units))
+        if result is None:
+            unit.append(file)
+            if len(unit) == unitfiles:
+                coordinator.submit(units, unit, settings, analyser)
+                unit = []
+                units += 1
+        finished.update(coordinator.completed())
+        while pending and ready():
+            yield collect()
+    if unit:
+        coordinator.submit(units, unit, settings, analyser)
+    while pending:
+        if not stopper.is_set():
+            return
+        if ready():
+            yield collect()
+        else:
+            finished.update(coordinator.completed(timeout=0.5))
+
+
+# Hands out units of files to network workers (see runworker) over an authenticated socket, and gathers their results.
+# Units held by a worker which disconnects are handed to another worker. A random key is made if none is given.
+class Coordinator:
+    def __init__(self, address, authkey=None, log=print):
+        self.authkey = authkey or secrets.token_hex(8).encode()
+        self.listener = Listener(address, authkey=self.authkey)
+        self.log = log
+        self.units = queue.Queue()  # Unit indexes with the pickled unit, waiting for a worker. None once closed
+        self.results = queue.Queue()  # Unit index and results, as workers finish them
+        self.closed = False
+        threading.Thread(target=self.accept, daemon=True).start()
+
+    # Host and port the coordinator is listening on.
+    @property
+    def address(self):
+        return self.listener.address
+
+    # Command for running a worker for this coordinator on another computer.
+    def workercommand(self):
+        host, port = self.address
+        if host in ("", "0.0.0.0"):
+            host = socket.gethostname()
+        return "quantifish --worker %s:%d --key %s" % (host, port, self.authkey.decode())
+
+    # Accept workers as they connect, serving each on its own thread.
+    def accept(self):
+        while not self.closed:
+            try:
+                connection = self.listener.accept()
+            except (OSError, EOFError, AuthenticationError):
+                continue
+            if self.closed:
+                connection.close()
+                return
+            threading.Thread(target=self.serve, args=(connection,), daemon=True).start()
+
+    # Send units to a worker one at a time, putting back the unit it holds if it disconnects.
+    def serve(self, connection):
+        unit = None
+        try:
+            while True:
+                unit = self.units.get()
+                if unit is None:
+                    self.units.put(None)  # Let the other workers know too.
+                    connection.send_bytes(pickle.dumps(None))
+                    return
+                index, data = unit
+                connection.send_bytes(data)
+                self.results.put((index, connection.recv()))
+                unit = None
+        except (OSError, EOFError):
+            if unit is not None and not self.closed:
+                self.log("A network worker disconnected, its files will be sent to another worker")
+                self.units.put(unit)
+        finally:
+            connection.close()
+
+    # Queue a unit of files to be analysed with the analyser by the next free worker.
+    def submit(self, index, files, settings, analyser):
+        self.units.put((index, pickle.dumps((index, list(files), settings, analyser))))
+
+    # Results of units finished since the last call, by unit index. Waits up to timeout seconds for the first.
+    def completed(self, timeout=0):
+        finished = {}
+        try:
+            index, results = self.results.get(timeout=timeout) if timeout else self.results.get_nowait()
+            while True:
+                finished[index] = deque(results)
+                index, results = self.results.get_nowait()
+        except queue.Empty:
+            return finished
+
+    # Stop handing out units and disconnect workers, which then finish.
+    def close(self):
+        self.closed = True
+        try:
+            while True:
+                self.units.get_nowait()
+        except queue.Empty:
+            pass
+        self.units.put(None)
+        host, port = self.address
+        try:  # Wake the accepting thread so it stops listening.
+            socket.create_connection(("localhost" if host in ("", "0.0.0.0") else host, port), timeout=1).close()
+        except OSError:
+            pass
+        self.listener.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+# Start a coordinator for network workers at address, logging the command to start workers with.
+def servecoordinator(address, authkey, log):
+    coordinator = Coordinator(address, authkey, log)
+    log("Waiting for network workers, start each with: " + coordinator.workercommand())
+    return coordinator
+
+
+# Unpickles units from a coordinator, finding QuantiFish's own functions and classes in this module whether the
+# coordinator ran QuantiFish as a script or imported it.
+class UnitUnpickler(pickle.Unpickler):
+    def find_class(self, module, name):
+        if module in ("__main__", "__mp_main__", "QuantiFish"):
+            return functools.reduce(getattr, name.split("."), sys.modules[__name__])
+        return super().find_class(module, name)
+
+
+# Analyse files for the coordinator at address until it has no more work, with up to processes files at once.
+# Files must be at the same paths on this computer as on the coordinator. Returns the number of files analysed.
+def runworker(address, authkey, processes=1, log=print):
+    pool = None
+    if processes > 1:
+        pool = ProcessPoolExecutor(max_workers=processes, mp_context=multiprocessing.get_context("spawn"))
+    try:
+        with ThreadPoolExecutor(max_workers=processes) as threads:
+            analysed = sum(threads.map(lambda i: workunits(address, authkey, pool, log), range(processes)))
+    finally:
+        if pool:
+            pool.shutdown(cancel_futures=True)
+    log("Worker finished! %d files analysed" % analysed)
+    return analysed
+
+
+# Analyse units from a single connection to the coordinator, in the process pool if one is given. Returns the number
+# of files analysed.
+def workunits(address, authkey, pool, log):
+    deadline = time.monotonic() + connectwait
+    while True:
+        try:
+            connection = Client(address, authkey=authkey)
+            break
+        except ConnectionRefusedError:  # Coordinator may not have started yet.
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(1)
+    analysed = 0
+    with connection:
+        while True:
+            try:
+                unit = UnitUnpickler(io.BytesIO(connection.recv_bytes())).load()
+            except (OSError, EOFError):
+                return analysed
+            if unit is None:
+                return analysed
+            index, files, settings, analyser = unit
+            results = []
+            for file in files:
+                log("Analysing: " + file)
+                results.append(workeranalysis(file, settings, analyser, pool))
+            try:
+                connection.send(results)
+            except OSError:
+                return analysed
+            analysed += len(files)
+
+
+# Analyse a file on a network worker. Failures are reported back as an invalid result rather than dropping the unit,
+# which would otherwise be handed to another worker to fail again.
+def workeranalysis(file, settings, analyser, pool):
+    try:
+        if pool:
+            return pool.submit(analyser, file, settings).result()
+        return analyser(file, settings)
+    except Exception as error:
+        return "Invalid", None, None, None, ["Analysis failed on %s: %r" % (socket.gethostname(), error)]
+
+
+# Split a [HOST:]PORT address, using host if none is given.
+def parseaddress(text, host):
+    addresshost, separator, port = text.rpartition(":")
+    return addresshost or host, int(port)
+
+
+# Memory held by an image, including the other channels of a colour image it's been taken from.
+def imagebytes(imagedata):
+    if isinstance(getattr(imagedata, "base", None), np.ndarray):
+        return imagedata.base.nbytes
+    return getattr(imagedata, "nbytes", 0)
+
+
+# Analyse a single image, reusing cached results if the file and settings haven't changed since it was last analysed.
+def cachedanalysis(file, settings, cache, analyser):
+    if cache is None:
+        return analyser(file, settings)
+    key = cache.key(file, settings)
+    result = cache.fetch(key, file, settings)
+    if result is None:
+        result = analyser(file, settings)
+        cache.store(key, settings, result)
+    return result
+
+
+# Read an image for analysis, returns the image (or band reader in low memory mode), its type, channel and messages.
+# Files which can't be read are returned as invalid, so they're skipped without stopping the run.
+def load_file(file, settings):
+    messages = []
+    try:
+        if settings.tilerows:  # Low memory mode, image is read in bands.
+            imagedata, imagetype, channel = open_reader(file, settings, messages.append)
+        else:
+            imagedata, imagetype, channel = open_file(file, settings, messages.append)
+    except (OSError, ValueError, Image.DecompressionBombError):
+        messages.append("Unable to read file, it may be corrupted or not an image")
+        return None, "Invalid", "Unknown", messages
+    return imagedata, imagetype, channel, messages
+
+
+# Analyse a single image. Does not touch the UI, so this can run in a worker process. An image already read by
+# load_file can be passed as loaded.
+def analyse_file(file, settings, loaded=None):
+    if loaded is None:
+        with timed("open_file"):
+            loaded = load_file(file, settings)
+    imagedata, imagetype, channel, messages = loaded
+    results = clusterdata = None
+    if imagetype == "Invalid":
+        messages.append("Invalid file type, analysis skipped")
+        return imagetype, channel, results, clusterdata, messages
+    if not settings.depthlocked and not settings.tempdepthlock:
+        with timed("bit_depth_detect"):
+            bit_depth_detect(imagedata.max(), settings, messages.append)
+        settings.tempdepthlock = True
+    thresh = settings.threshold * settings.scalemultiplier
+    try:
+        if settings.tilerows:
+            with timed("tiledstats"):
+                results, clusterdata = tiledstats(imagedata, thresh, settings, file)
+        else:
+            with timed("genstats"):
+                results, clusterdata = genstats(imagedata, thresh, settings, file)
+    except (AttributeError, ValueError, TypeError, OSError, PermissionError, IOError):
+        messages.append("Analysis failed, image may be corrupted. Please report this!")
+    return imagetype, channel, results, clusterdata, messages
+
+
+# Measure a single image at many thresholds from its intensity histogram, for use as an analyser in iteranalysis.
+# Thresholds are on the displayed 0-256 scale. Results are the maximum and minimum followed by the integrated
+# intensity and positive pixel count at each threshold.
+def sweep_file(file, settings, thresholds, loaded=None):
+    imagedata, imagetype, channel, messages = loaded or load_file(file, settings)
+    results = None
+    if imagetype == "Invalid":
+        messages.append("Invalid file type, analysis skipped")
+        return imagetype, channel, results, None, messages
+    try:
+        if settings.tilerows:
+            values, counts = mergehistograms([histogram(imagedata.read(y0, y1, imagedata.channel))
+                                              for y0, y1 in imagedata.bands()])
+        else:
+            values, counts = histogram(imagedata)
+    except (OSError, ValueError, Image.DecompressionBombError):
+        messages.append("Unable to read file, it may be corrupted or not an image")
+        return "Invalid", channel, results, None, messages
+    if not settings.depthlocked and not settings.tempdepthlock:
+        bit_depth_detect(values[-1], settings, messages.append)
+        settings.tempdepthlock = True
+    intints, positives = sweepstats(values, counts, np.asarray(thresholds) * settings.scalemultiplier)
+    results = (values[-1], values[0], list(zip(intints.tolist(), positives.tolist())))
+    return imagetype, channel, results, None, messages
+
+
+# Run an analyser while recording the time and peak memory of each stage, for use in iteranalysis. Runs in worker
+# processes too, so the timings are handed to record as part of the messages and picked out by Profiler.record.
+def profiledanalysis(analyser, record, file, settings, **kwargs):
+    global stagetimer
+    if not tracemalloc.is_tracing():
+        tracemalloc.start()
+    stagetimer = StageTimer()
+    try:
+        result = analyser(file, settings, **kwargs)
+    finally:
+        stages, stagetimer = stagetimer.stages, None
+    return record(file, result, stages)
+
+
+# Time a stage of analysis if profiling, otherwise does nothing.
+def timed(name):
+    if stagetimer is None:
+        return nullcontext()
+    return stagetimer.stage(name)
+
+
+# Time saving a file's results if there's a profiler, otherwise does nothing.
+def writertimer(profiler, file, name):
+    if profiler is None:
+        return nullcontext()
+    return profiler.stage(file, name)
+
+
+# Wall time and peak memory (above that at the start) for named stages. Time spent in nested stages is counted
+# against those stages rather than the enclosing one.
+class StageTimer:
+    def __init__(self):
+        self.stages = {}  # {name: (seconds, peak bytes)}
+        self.stack = []  # Running stages as [start time, time in nested stages, peak memory, starting memory]
+
+    @contextmanager
+    def stage(self, name):
+        current, peak = tracemalloc.get_traced_memory()
+        if self.stack:  # Keep the enclosing stage's peak before resetting it.
+            self.stack[-1][2] = max(self.stack[-1][2], peak)
+        tracemalloc.reset_peak()
+        entry = [time.perf_counter(), 0.0, current, current]
+        self.stack.append(entry)
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - entry[0]
+            peak = max(entry[2], tracemalloc.get_traced_memory()[1])
+            self.stack.pop()
+            if self.stack:
+                self.stack[-1][1] += elapsed
+                self.stack[-1][2] = max(self.stack[-1][2], peak)
+            seconds, memory = self.stages.get(name, (0.0, 0))
+            self.stages[name] = (seconds + elapsed - entry[1], max(memory, peak - entry[3]))
+
+
+# Collects stage timings for each file in a run, writing them to a csv file and summarising them for the log. Errors
+# writing the file are logged if a log is given.
+class Profiler:
+    def __init__(self, filepath, log=None):
+        self.sink = CSVSink(filepath, log, headings=('File', 'Stage', 'Seconds', 'Peak Memory (MB)'))
+        self.totals = {}  # {stage: [seconds, images, peak bytes]}
+        self.timer = StageTimer()
+        self.tracing = not tracemalloc.is_tracing()  # Stop tracing memory on closing if we started it
+        if self.tracing:
+            tracemalloc.start()
+
+    # Attach stage timings to an analysis result, so they can be passed back from a worker process.
+    @staticmethod
+    def record(file, result, stages):
+        imagetype, channel, results, clusterdata, messages = result
+        return imagetype, channel, results, clusterdata, messages + [("timings", stages)]
+
+    # Time saving the results of a file.
+    @contextmanager
+    def stage(self, file, name):
+        self.timer.stages = {}
+        with self.timer.stage(name):
+            yield
+        self.add(file, self.timer.stages)
+
+    # Take the stage timings off a result and record them. Returns the result as an analyser would.
+    def collect(self, file, result):
+        imagetype, channel, results, clusterdata, messages = result
+        for message in messages:
+            if isinstance(message, tuple):
+                self.add(file, message[1])
+        return imagetype, channel, results, clusterdata, [message for message in messages
+                                                         if not isinstance(message, tuple)]
+
+    def add(self, file, stages):
+        for name, (seconds, memory) in stages.items():
+            self.sink.writerow([file, name, round(seconds, 6), round(memory / 2 ** 20, 3)])
+            total = self.totals.setdefault(name, [0.0, 0, 0])
+            total[0] += seconds
+            total[1] += 1
+            total[2] = max(total[2], memory)
+
+    # Lines for the log summarising time spent in each stage.
+    def summary(self):
+        overall = sum(seconds for seconds, images, memory in self.totals.values()) or 1
+        return ["%s: %.2fs total (%.0f%%), %.3fs per image, peak %.1f MB" %
+                (name, seconds, seconds / overall * 100, seconds / images, memory / 2 ** 20)
+                for name, (seconds, images, memory) in sorted(self.totals.items(), key=lambda item: -item[1][0])]
+
+    def close(self):
+        self.sink.close()
+        if self.tracing:
+            tracemalloc.stop()
+            self.tracing = False
+
+
+# Detect the bit depth for a run from the highest value in every image, so that it doesn't depend on which image
+# is analysed first. Locks the depth in settings for the run, unless it's already set. Images are read a band at a
+# time, several at once. The maxima are kept in the cache if one is given, so unchanged images aren't read again.
+def prescandepth(filelist, settings, stopper, cache=None, log=print):
+    if settings.depthlocked or settings.tempdepthlock:
+        return
+    keys = [cache.maximumkey(file, settings) if cache else None for file in filelist]
+    maxima = [cache.fetchmaximum(key) if cache else None for key in keys]
+    toscan = [i for i, maximum in enumerate(maxima) if maximum is None]
+    log("Checking bit depth of %d images" % len(filelist) +
+        (" (%d from previous runs)" % (len(filelist) - len(toscan)) if len(toscan) < len(filelist) else ""))
+    readsettings = copy.copy(settings)
+    readsettings.tilerows = settings.tilerows or lowmemoryrows
+    pool = ThreadPoolExecutor(max_workers=scanthreads)
+    jobs = {pool.submit(filemaximum, filelist[i], readsettings): i for i in toscan}
+    pending = set(jobs)
+    try:
+        while pending:
+            if not stopper.is_set():
+                return
+            done, pending = wait(pending, timeout=0.5, return_when=FIRST_COMPLETED)
+            for job in done:
+                maxima[jobs[job]] = maximum = job.result()
+                if maximum is not None and cache:
+                    cache.storemaximum(keys[jobs[job]], maximum)
+    finally:
+        # A with block would wait for the images still being read, which holds up aborting a run.
+        pool.shutdown(wait=False, cancel_futures=True)
+    maxima = [maximum for maximum in maxima if maximum is not None]
+    if maxima:
+        bit_depth_detect(max(maxima), settings, log)
+        settings.tempdepthlock = True
+        log("Bit depth set to %d-bit for this run" % settings.currentdepth)
+
+
+# Highest value in the channel of a file that would be analysed, None if it isn't a valid image.
+def filemaximum(file, settings):
+    try:
+        reader, imagetype, channel = open_reader(file, settings, lambda message: None)
+        if imagetype == "Invalid":
+            return None
+        return reader.max()
+    except (OSError, ValueError, MemoryError, Image.DecompressionBombError):
+        return None
+
+
+# Results of previous analyses, kept in an sqlite database so unchanged images can be skipped when a directory is
+# analysed again. Results are stored against the file's path, size and modification time and the settings which
+# affect them, and saved to disk every flushinterval seconds and when the cache is closed.
+class ResultsCache:
+    def __init__(self, filepath):
+        self.connection = sqlite3.connect(filepath)
+        self.connection.execute("CREATE TABLE IF NOT EXISTS results (file TEXT, settings TEXT, size INTEGER, "
+                                "modified INTEGER, data BLOB, PRIMARY KEY (file, settings))")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS maxima (file TEXT, channel TEXT, size INTEGER, "
+                                "modified INTEGER, maximum REAL, PRIMARY KEY (file, channel))")
+        self.lastcommit = time.monotonic()
+
+    # Lookup key for a file analysed with the given settings, None if the file can't be read.
+    def key(self, file, settings):
+        try:
+            stats = os.stat(file)
+        except OSError:
+            return None
+        if settings.depthlocked or settings.tempdepthlock:
+            depth = settings.currentdepth
+        else:
+            depth = "Detect"  # Results will include the depth detected from this image
+        analysis = (version, settings.threshold, settings.filtermode, settings.channel, depth, settings.wantclusters,
+                    settings.minarea, settings.wantfluor50, settings.wantspatial, settings.gridboxsize,
+                    settings.extraboxsizes, settings.clustersave)
+        return os.path.abspath(file), repr(analysis), stats.st_size, stats.st_mtime_ns
+
+    # Results from a previous analysis, or None. Applies the bit depth detected at the time, like analyse_file would.
+    def fetch(self, key, file, settings):
+        if key is None:
+            return None
+        row = self.connection.execute("SELECT data FROM results WHERE file = ? AND settings = ? AND size = ? AND "
+                                      "modified = ?", key).fetchone()
+        if row is None:
+            return None
+        imagetype, channel, results, clusterdata, messages, depth = pickle.loads(row[0])
+        if depth is not None and not settings.depthlocked and not settings.tempdepthlock:
+            settings.currentdepth, settings.scalemultiplier, settings.maxrange = depth
+            settings.tempdepthlock = True
+        if clusterdata:  # Report the file as it was named in this run
+            clusterdata = [[file] + focus[1:] for focus in clusterdata]
+        return imagetype, channel, results, clusterdata, messages + ["Reused results from a previous run"]
+
+    # Save the results of analysing a file. Failed analyses aren't saved so they're tried again next time.
+    def store(self, key, settings, result):
+        imagetype, channel, results, clusterdata, messages = result
+        if key is None or (results is None and imagetype != "Invalid"):
+            return
+        depth = None
+        if settings.tempdepthlock and not settings.depthlocked:
+            depth = (settings.currentdepth, settings.scalemultiplier, settings.maxrange)
+        messages = [message for message in messages if isinstance(message, str)]  # Leave out any stage timings.
+        data = pickle.dumps((imagetype, channel, results, clusterdata, messages, depth))
+        self.connection.execute("INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?)", key + (data,))
+        if time.monotonic() - self.lastcommit >= flushinterval:
+            self.connection.commit()
+            self.lastcommit = time.monotonic()
+
+    # Lookup key for the highest value of a file's channel, None if the file can't be read. The channel setting is
+    # only used in RGB filter mode (see pickchannel), otherwise the channel is detected from the image itself.
+    @staticmethod
+    def maximumkey(file, settings):
+        try:
+            stats = os.stat(file)
+        except OSError:
+            return None
+        channel = settings.channel if settings.filtermode == 2 else "Detect"
+        return os.path.abspath(file), channel, stats.st_size, stats.st_mtime_ns
+
+    # Highest value found in a file by a previous bit depth pre-scan, or None.
+    def fetchmaximum(self, key):
+        if key is None:
+            return None
+        row = self.connection.execute("SELECT maximum FROM maxima WHERE file = ? AND channel = ? AND size = ? AND "
+                                      "modified = ?", key).fetchone()
+        return None if row is None else row[0]
+
+    def storemaximum(self, key, maximum):
+        if key is not None:
+            self.connection.execute("INSERT OR REPLACE INTO maxima VALUES (?, ?, ?, ?, ?)", key + (float(maximum),))
+
+    def close(self):
+        self.connection.commit()
+        self.connection.close()
+
+
+# Column headings for the main output file
+def mainheadings(settings):
+    headings = ('File', 'Integrated Intensity', 'Positive Pixels', 'Maximum', 'Minimum', 'Stain Polygon Area')
+    if settings.wantclusters:
+        headings += ('Total Foci', 'Total Peaks', 'Large Foci', 'Peaks in Large Foci',
+                     'Integrated Intensity in Large Foci', 'Positive Pixels in Large Foci')
+        if settings.wantfluor50:
+            headings += ('Fluor50',)
+        if settings.wantspatial:
+            headings += ('Total Grid Boxes', 'Positive Grid Boxes', 'Focus Polygon Area', 'IFDmax')
+            for boxsize in settings.extraboxsizes:
+                headings += ('Total Grid Boxes (%d)' % boxsize, 'Positive Grid Boxes (%d)' % boxsize)
+    headings += ('Displayed Threshold', 'Computed Threshold', 'Channel')
+    return headings
+
+
+# Column headings for the foci output file
+def clusterheadings(settings):
+    headings = (
+        'File', 'Focus ID', 'Focus Location', 'Focus Area', 'Maximum Intensity', 'Minimum Intensity',
+        'Average Intensity', 'Integrated Intensity')
+    if settings.wantfluor50:
+        headings += ('Percent Intensity', 'Cumulative Intensity', 'Cumulative Percent Intensity')
+    return headings
+
+
+# Names and types of the columns in Parquet foci output. Focus Location is split into separate Y and X columns.
+def focuscolumns(settings):
+    columns = [('File', str), ('Focus ID', np.int64), ('Focus Y', np.int64), ('Focus X', np.int64)]
+    columns += [(heading, np.float64) for heading in clusterheadings(settings)[3:]]
+    return columns
+
+
+# Row of the main output file for a single image
+def datarow(exportpath, exportdata, settings, channel):
+    return [exportpath, *exportdata, settings.threshold, settings.threshold * settings.scalemultiplier, channel]
+
+
+# Csv output which keeps its file open for the whole run. Rows are buffered and written out every flushrows rows
+# or flushinterval seconds and when the sink is closed, so an aborted run still leaves its results on disk. If headings
+# are given the file is replaced, otherwise rows are appended. Write errors are raised unless a log is given, in which
+# case they're reported and the rows kept to try again at the next flush.
+class CSVSink:
+    def __init__(self, filepath, log=None, headings=None):
+        self.filepath = filepath
+        self.log = log
+        self.rows = []
+        self.file = open(filepath, 'a' if headings is None else 'w', newline="\n", encoding="utf-8")
+        self.writer = writer(self.file)
+        if headings is not None:
+            self.writer.writerow(headings)
+        self.lastflush = time.monotonic()
+
+    def writerow(self, row):
+        self.rows.append(row)
+        self.checkflush()
+
+    def writerows(self, rows):
+        self.rows.extend(rows)
+        self.checkflush()
+
+    def checkflush(self):
+        if len(self.rows) >= flushrows or time.monotonic() - self.lastflush >= flushinterval:
+            self.flush()
+
+    def flush(self):
+        self.lastflush = time.monotonic()
+        try:
+            if self.file is None:
+                self.file = open(self.filepath, 'a', newline="\n", encoding="utf-8")
+                self.writer = writer(self.file)
+            self.writer.writerows(self.rows)
+            self.file.flush()
+            self.rows = []
+        except (OSError, PermissionError, IOError):
+            if self.log is None:
+                raise
+            self.log("Unable to write to save file, please make sure it isn't open in another program!")
+            # Reopen on the next attempt, the old handle may be unusable.
+            try:
+                self.file.close()
+            except (AttributeError, OSError):
+                pass
+            self.file = None
+
+    def close(self):
+        try:
+            self.flush()
+        finally:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+            if self.rows and self.log is not None:
+                self.log("%d rows could not be saved to %s" % (len(self.rows), self.filepath))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+# Foci output in Parquet format, takes the same rows as a CSVSink. Rows are converted to typed columns and written
+# as a row group every parquetrows rows and when the sink is closed.
+class ParquetSink:
+    def __init__(self, filepath, settings):
+        import pyarrow
+        import pyarrow.parquet
+        self.columns = focuscolumns(settings)
+        self.schema = pyarrow.schema([(name, pyarrow.string() if kind is str else pyarrow.from_numpy_dtype(kind))
+                                      for name, kind in self.columns])
+        self.rows = []
+        self.writer = pyarrow.parquet.ParquetWriter(filepath, self.schema)
+
+    def writerows(self, rows):
+        self.rows.extend(rows)
+        if len(self.rows) >= parquetrows:
+            self.flush()
+
+    def flush(self):
+        import pyarrow
+        if not self.rows:
+            return
+        values = list(zip(*self.rows))
+        locations = np.array(values[2], dtype=np.int64).reshape(-1, 2)
+        values[2:3] = [locations[:, 0], locations[:, 1]]
+        arrays = [pyarrow.array(column if kind is str else np.asarray(column, dtype=kind))
+                  for column, (name, kind) in zip(values, self.columns)]
+        self.writer.write_table(pyarrow.Table.from_arrays(arrays, schema=self.schema))
+        self.rows = []
+
+    def close(self):
+        try:
+            self.flush()
+        finally:
+            self.writer.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
 # Open a file and convert it into a single channel image.
-def open_file(filepath):
-    currentmode = app.filtermode.get()
-    chandef = {"Detect": 0, "Blue": 3, "Green": 2, "Red": 1}
-    channelids = ["Red", "Green", "Blue"]
-    desiredcolour = chandef[app.channelselect.get()]
-    inputarray = Image.open(filepath)
-    inputarray = np.array(inputarray)
-    if inputarray.ndim == 2:
+def open_file(filepath, settings, log):
+    reader = ImageReader(filepath, lowmemoryrows)
+    channel = "Unknown"
+    channelindex = None
+    if reader.channels == 1:
         imagetype = "greyscale"
-        app.currentchannel = "Grey"
-    elif inputarray.ndim == 3:
-        dimensions = inputarray.shape[2]
-        if dimensions == 3:
-            imagetype = "RGB"
-        elif dimensions == 4:
-            imagetype = "RGBA"
-        else:
+        channel = "Grey"
+    else:
+        # Only the channel being analysed is read out of colour images. If it has to be detected, every channel's
+        # maximum is found in a single pass.
+        imagetype = colourtype(reader.channels, log)
+        channelindex, channel = pickchannel(reader.channelmaximum, settings, log)
+        if channelindex is None:
             imagetype = "Invalid"
-            app.logevent("Invalid image format, skipping...")
-
-        if currentmode == 2 and desiredcolour != 0:  # Not in detect mode
-            inputarray = inputarray[:, :, desiredcolour - 1]
-            app.currentchannel = channelids[desiredcolour - 1]
-        else:  # Check if only one channel has data.
-            populated_channels = []
-            for i in range(0, 3):  # Scan RGB channels, not A. List channels containing data.
-                if np.max(inputarray[:, :, i]) > 0:
-                    populated_channels.append(i)
-            if len(populated_channels) == 1:  # Single colour RGB image, work on just the channel of interest
-                inputarray = inputarray[:, :, populated_channels[0]]
-                app.currentchannel = channelids[populated_channels[0]]
-            elif len(populated_channels) == 0:  # All channels blank
-                app.logevent("Image appears to be blank, skipping")
-                imagetype = "Invalid"
-            else:  # Multi colour overlay
-                app.logevent("Image has multiple channels with data but no channel is specified for analysis, skipping")
-                imagetype = "Invalid"
+    return reader.readchannel(channelindex), imagetype, channel
+
+
+# Open a file for analysis in bands of rows, choosing the channel to analyse like open_file.
+def open_reader(filepath, settings, log):
+    reader = ImageReader(filepath, settings.tilerows)
+    channel = "Unknown"
+    if reader.channels == 1:
+        imagetype = "greyscale"
+        channel = "Grey"
     else:
-        imagetype = "Invalid"
-    if imagetype != "Invalid":
-        bit_depth_detect(inputarray)
-    return inputarray, imagetype
+        imagetype = colourtype(reader.channels, log)
+        reader.channel, channel = pickchannel(reader.channelmaximum, settings, log)
+        if reader.channel is None:
+            imagetype = "Invalid"
+    return reader, imagetype, channel
+
+
+# Pixel layouts which can be read straight from uncompressed tiffs. {rawmode: (dtype, channels)}
+rawlayouts = {"L": ("u1", 1), "I;16": ("<u2", 1), "I;16N": ("=u2", 1), "I;16B": (">u2", 1), "RGB": ("u1", 3),
+              "RGBA": ("u1", 4), "RGBX": ("u1", 4)}
 
 
-# Detect bit depth of the current image.
-def bit_depth_detect(imgarray):
-    max_value = imgarray.max()
-    if app.depthlocked or app.tempdepthlock:
+# Held while Pillow's decompression bomb check is lifted, so images aren't decoded unchecked in other threads.
+headerlock = threading.Lock()
+
+
+# Open an image to read its header. Images over Pillow's size limit are opened with the decompression bomb check
+# lifted, as reading the header is safe, they're refused if they have to be decoded in full.
+def openheader(filepath):
+    try:
+        return Image.open(filepath)
+    except Image.DecompressionBombError:
+        with headerlock:
+            limit, Image.MAX_IMAGE_PIXELS = Image.MAX_IMAGE_PIXELS, None
+            try:
+                return Image.open(filepath)
+            finally:
+                Image.MAX_IMAGE_PIXELS = limit
+
+
+# Reads an image in bands of rows. Uncompressed tiffs are memory-mapped so that only the rows and channel needed
+# are pulled into memory, other images are decoded in full the first time they're read.
+class ImageReader:
+    def __init__(self, filepath, bandrows):
+        self.filepath = filepath
+        self.bandrows = bandrows  # Rows per band
+        self.channel = None  # Channel to analyse in colour images
+        self.maxima = None  # Cached maximum of each channel
+        self.image = None  # Image decoded by PIL, for files which can't be memory-mapped
+        self.decoded = None  # Array of the decoded image, for reading those in bands
+        self.tiles = []  # Memory-mapped strips/tiles as (x0, y0, x1, y1, array)
+        with openheader(filepath) as image:
+            self.xdim, self.ydim = image.size
+            self.channels = len(image.getbands())
+            tiles = list(image.tile)
+        self.maptiles(tiles)
+        # Images which can't be memory-mapped have to be decoded in full, so Pillow's size limit applies to them.
+        if not self.tiles and Image.MAX_IMAGE_PIXELS and self.xdim * self.ydim > 2 * Image.MAX_IMAGE_PIXELS:
+            raise Image.DecompressionBombError("Image size (%d pixels) is too large to decode" %
+                                               (self.xdim * self.ydim))
+
+    # Memory-map the strips/tiles of an uncompressed tiff, leaves tiles empty for other images.
+    def maptiles(self, tiles):
+        rawmodes = {tile[3][0] for tile in tiles if tile[0] == "raw"}
+        if len(tiles) == 0 or any(tile[0] != "raw" or tile[3][2] != 1 for tile in tiles) or len(rawmodes) != 1:
+            return
+        rawmode = rawmodes.pop()
+        if rawmode not in rawlayouts or rawlayouts[rawmode][1] != self.channels:
+            return
+        dtype, channels = np.dtype(rawlayouts[rawmode][0]), rawlayouts[rawmode][1]
+        try:
+            filemap = np.memmap(self.filepath, dtype=np.uint8, mode='r')
+            for codec, (x0, y0, x1, y1), offset, (tilemode, stride, orientation) in tiles:
+                tilewidth = stride // (dtype.itemsize * channels) if stride else x1 - x0
+                self.tiles.append((x0, y0, x1, y1, np.ndarray((y1 - y0, tilewidth, channels), dtype=dtype,
+                                                              buffer=filemap, offset=offset)))
+        except (TypeError, ValueError):  # Truncated file, let PIL deal with it.
+            self.tiles = []
+
+    # Row ranges of each band in the image.
+    def bands(self):
+        for y0 in range(0, self.ydim, self.bandrows):
+            yield y0, min(y0 + self.bandrows, self.ydim)
+
+    # Read rows y0 to y1 of a channel (all channels if None) into a new native-endian array.
+    def read(self, y0, y1, channel):
+        if self.channels == 1:
+            channel = 0
+        if not self.tiles:
+            if self.decoded is None:
+                self.decoded = np.array(self.decode())
+                self.image = None
+            band = self.decoded[y0:y1]
+            if band.ndim == 3 and channel is not None:
+                band = band[:, :, channel]
+            return np.array(band, dtype=band.dtype.newbyteorder("="))
+        dtype = self.tiles[0][4].dtype.newbyteorder("=")
+        if channel is None:
+            band = np.empty((y1 - y0, self.xdim, self.channels), dtype=dtype)
+        else:
+            band = np.empty((y1 - y0, self.xdim), dtype=dtype)
+        for x0, tiley0, x1, tiley1, tile in self.tiles:
+            top, bottom = max(y0, tiley0), min(y1, tiley1)
+            if top < bottom:
+                data = tile[top - tiley0:bottom - tiley0, :x1 - x0]
+                band[top - y0:bottom - y0, x0:x1] = data if channel is None else data[:, :, channel]
+        return band
+
+    # Read the whole of a channel (all channels if None). Decoded colour images have the channel split out by PIL,
+    # so the other channels are never converted to an array.
+    def readchannel(self, channel):
+        if self.tiles or self.decoded is not None:
+            return self.read(0, self.ydim, channel)
+        image = self.decode()
+        if self.channels > 1 and channel is not None:
+            image = image.getchannel(channel)
+        return np.array(image)
+
+    # Decode the whole image with PIL, the first time it's needed.
+    def decode(self):
+        if self.image is None:
+            with headerlock:
+                self.image = Image.open(self.filepath)
+            self.image.load()
+        return self.image
+
+    # Highest value in channel i. All channels are scanned in a single pass the first time this is needed.
+    def channelmaximum(self, i):
+        if self.maxima is None:
+            if not self.tiles and self.decoded is None and self.channels > 1:  # PIL gets every band's range at once.
+                self.maxima = np.array([high for low, high in self.decode().getextrema()], dtype=np.float64)
+                return self.maxima[i]
+            self.maxima = np.zeros(self.channels, dtype=np.float64)
+            for y0, y1 in self.bands():
+                band = self.read(y0, y1, None).reshape(y1 - y0, self.xdim, self.channels)
+                # Reducing each channel separately is much quicker than reducing across them.
+                bandmax = [band[:, :, channel].max() for channel in range(self.channels)]
+                self.maxima = np.maximum(self.maxima, bandmax)
+        return self.maxima[i]
+
+    # Highest value in the channel being analysed.
+    def max(self):
+        if self.maxima is not None:
+            return self.maxima[self.channel or 0]
+        return max(self.read(y0, y1, self.channel).max() for y0, y1 in self.bands())
+
+
+# Image type for a colour image with the given number of channels.
+def colourtype(dimensions, log):
+    if dimensions == 3:
+        return "RGB"
+    elif dimensions == 4:
+        return "RGBA"
+    log("Invalid image format, skipping...")
+    return "Invalid"
+
+
+# Choose the channel of a colour image to analyse. Returns channel index (None if unusable) and name.
+def pickchannel(channelmaximum, settings, log):
+    chandef = {"Detect": 0, "Blue": 3, "Green": 2, "Red": 1}
+    channelids = ["Red", "Green", "Blue"]
+    desiredcolour = chandef[settings.channel]
+    if settings.filtermode == 2 and desiredcolour != 0:  # Not in detect mode
+        return desiredcolour - 1, channelids[desiredcolour - 1]
+    # Check if only one channel has data.
+    populated_channels = []
+    for i in range(0, 3):  # Scan RGB channels, not A. List channels containing data.
+        if channelmaximum(i) > 0:
+            populated_channels.append(i)
+    if len(populated_channels) == 1:  # Single colour RGB image, work on just the channel of interest
+        return populated_channels[0], channelids[populated_channels[0]]
+    elif len(populated_channels) == 0:  # All channels blank
+        log("Image appears to be blank, skipping")
+    else:  # Multi colour overlay
+        log("Image has multiple channels with data but no channel is specified for analysis, skipping")
+    return None, "Unknown"
+
+
+# Detect bit depth of the current image. Updates the depth state held by the UI or a settings snapshot.
+def bit_depth_detect(max_value, depthstate, log):
+    if depthstate.depthlocked or depthstate.tempdepthlock:
         return
     if max_value < 256:
         depth = 8
@@ -977,10 +2353,10 @@ def bit_depth_detect(imgarray):
     else:
         depth = 16
         depthname = '16-bit'
-    if app.currentdepth < depth:
-        app.scalemultiplier, app.maxrange, = app.depthmap[depthname]
-        app.currentdepth = depth
-        app.logevent("Detected bit depth: " + depthname)
+    if depthstate.currentdepth < depth:
+        depthstate.scalemultiplier, depthstate.maxrange, = depthmap[depthname]
+        depthstate.currentdepth = depth
+        log("Detected bit depth: " + depthname)
     return
 
 
@@ -995,70 +2371,404 @@ def bit_depth_reset():
 
 
 # Data generators
-def genstats(inputimage, threshold, wantclusters, file):
-    max_value = np.amax(inputimage)
-    min_value = np.amin(inputimage)
-    mask = (inputimage < threshold)
-    inputimage[mask] = 0
-    intint = np.sum(inputimage)
-    count = np.count_nonzero(inputimage)
-    coordlist = np.argwhere(inputimage > 0)
-    if len(coordlist) > 2:
+def genstats(inputimage, threshold, settings, file):
+    max_value, min_value, intint, count, hullpoints = thresholdstats(inputimage, threshold, 0, settings.backend)
+    arearesult = hullarea(hullpoints)
+    results_pack = (intint, count, max_value, min_value, arearesult)
+    clusterdata = []
+    if settings.wantclusters:
+        with timed("getclusters"):
+            cluster_results, clusterdata = getclusters(inputimage, threshold, settings, file)
+        results_pack += cluster_results
+    return results_pack, clusterdata
+
+
+# Threshold an image in place and reduce it to its intensity statistics in a single pass over cache sized chunks.
+# Returns the maximum and minimum before thresholding, integrated intensity, positive pixel count and the row
+# extrema of the staining as candidate points for the stain polygon, offset by yoffset rows.
+def thresholdstats(inputimage, threshold, yoffset, backend="numpy"):
+    rows = max(chunkpixels // max(inputimage.shape[1], 1), 1)
+    if backend == "numba" and inputimage.size and np.issubdtype(inputimage.dtype, np.integer) \
+            and threshold == int(threshold) \
+            and np.iinfo(inputimage.dtype).min <= threshold <= np.iinfo(inputimage.dtype).max:
+        return numbathresholdstats(inputimage, inputimage.dtype.type(threshold), yoffset, rows)
+    max_value = min_value = None
+    intint = sumtype(inputimage.dtype)(0)
+    count = np.int64(0)
+    hullpoints = []
+    for y0 in range(0, inputimage.shape[0], rows):
+        chunk = inputimage[y0:y0 + rows]
+        chunkmax, chunkmin = np.amax(chunk), np.amin(chunk)
+        max_value = chunkmax if max_value is None else max(max_value, chunkmax)
+        min_value = chunkmin if min_value is None else min(min_value, chunkmin)
+        if chunkmax < threshold:
+            chunk[:] = 0
+            continue
+        if chunkmin < threshold:
+            chunk[chunk < threshold] = 0
+        intint += np.sum(chunk, dtype=sumtype(chunk.dtype))
+        positive = chunk > 0
+        chunkcount = np.count_nonzero(positive)
+        if not chunkcount:
+            continue
+        count += chunkcount
+        # The hull of the staining only depends on the leftmost and rightmost positive pixel of each row.
+        stainedrows = np.flatnonzero(positive.any(axis=1))
+        left = np.argmax(positive, axis=1)[stainedrows]
+        right = positive.shape[1] - 1 - np.argmax(positive[:, ::-1], axis=1)[stainedrows]
+        stainedrows += yoffset + y0
+        hullpoints.append(np.column_stack((np.concatenate((stainedrows, stainedrows)), np.concatenate((left, right)))))
+    hullpoints = np.concatenate(hullpoints) if hullpoints else np.zeros((0, 2), dtype=np.intp)
+    return max_value, min_value, intint, count, hullpoints
+
+
+# thresholdstats in a single pass with the compiled kernel, for integer images with a threshold of the same type. Hull
+# points are grouped into chunks of rows like thresholdstats, so the results are identical.
+def numbathresholdstats(inputimage, threshold, yoffset, rows):
+    total = np.zeros(1, dtype=sumtype(inputimage.dtype))
+    max_value, min_value, count, left, right = numbakernel(thresholdkernel)(inputimage, threshold, total)
+    stainedrows = np.flatnonzero(left >= 0)
+    bounds = np.searchsorted(stainedrows, np.arange(0, inputimage.shape[0] + rows, rows))
+    hullpoints = [np.column_stack((np.concatenate((chunkrows, chunkrows)) + yoffset,
+                                   np.concatenate((left[chunkrows], right[chunkrows]))))
+                  for chunkrows in (stainedrows[start:end] for start, end in zip(bounds[:-1], bounds[1:]))
+                  if len(chunkrows)]
+    hullpoints = np.concatenate(hullpoints) if hullpoints else np.zeros((0, 2), dtype=np.intp)
+    dtype = inputimage.dtype.type
+    return dtype(max_value), dtype(min_value), total[0], np.int64(count), hullpoints
+
+
+# Accumulator type for summing pixels, wide enough that 16-bit images can't overflow on any platform.
+def sumtype(dtype):
+    if np.issubdtype(dtype, np.floating):
+        return np.float64
+    elif np.issubdtype(dtype, np.signedinteger):
+        return np.int64
+    return np.uint64
+
+
+# Kernels for the numba backend, written as plain loops and compiled by numbakernel on first use.
+
+# Zero pixels below the threshold, returning the maximum and minimum before thresholding, the number of positive
+# pixels and the leftmost and rightmost positive pixel of each row (-1 if none). Positive pixels are summed into total.
+def thresholdkernel(image, threshold, total):
+    ydim, xdim = image.shape
+    left = np.full(ydim, -1, dtype=np.intp)
+    right = np.full(ydim, -1, dtype=np.intp)
+    max_value = min_value = image[0, 0]
+    zero = threshold - threshold  # Zero of the image type, mixing in Python integers would promote sums to floats.
+    count = 0
+    accumulated = total[0]
+    for y in range(ydim):
+        row = image[y]
+        rowcount = 0
+        # Branch-free so the compiler can vectorise the row, edges are only searched for in stained rows.
+        for x in range(xdim):
+            value = row[x]
+            max_value = max(max_value, value)
+            min_value = min(min_value, value)
+            positive = value >= threshold and value > 0
+            row[x] = value if value >= threshold else zero
+            accumulated += value if positive else zero
+            rowcount += positive
+        if rowcount:
+            count += rowcount
+            x = 0
+            while not row[x] > 0:
+                x += 1
+            left[y] = x
+            x = xdim - 1
+            while not row[x] > 0:
+                x -= 1
+            right[y] = x
+    total[0] = accumulated
+    return max_value, min_value, count, left, right
+
+
+# Label 8-connected positive pixels into a zeroed labels array with a union-find pass, then number the labels in raster
+# order (as skimage does) while gathering the statistics labelstats would, summing in the same pixel order.
+def labelkernel(image, yoffset, labels):
+    ydim, xdim = image.shape
+    stained = np.zeros(ydim, dtype=np.bool_)  # Rows with any labels, the rest are skipped.
+    parent = np.zeros(1024, dtype=np.intp)
+    nextlabel = 1
+    for y in range(ydim):
+        row = image[y]
+        for x in range(xdim):
+            if not row[x] > 0:
+                continue
+            stained[y] = True
+            current = 0
+            for ny, nx in ((y - 1, x - 1), (y - 1, x), (y - 1, x + 1), (y, x - 1)):
+                if ny < 0 or nx < 0 or nx >= xdim or not stained[ny] or labels[ny, nx] == 0:
+                    continue
+                root = labels[ny, nx]
+                while parent[root] != root:
+                    parent[root] = parent[parent[root]]
+                    root = parent[root]
+                if current == 0:
+                    current = root
+                elif root != current:  # Merge the two clusters under the lower label.
+                    if root < current:
+                        parent[current] = root
+                        current = root
+                    else:
+                        parent[root] = current
+            if current == 0:
+                if nextlabel == len(parent):
+                    parent = np.concatenate((parent, np.zeros(len(parent), dtype=np.intp)))
+                parent[nextlabel] = nextlabel
+                current = nextlabel
+                nextlabel += 1
+            labels[y, x] = current
+    final = np.zeros(nextlabel, dtype=np.intp)
+    areas = np.zeros(nextlabel, dtype=np.int64)
+    sums = np.zeros(nextlabel, dtype=np.float64)
+    ysums = np.zeros(nextlabel, dtype=np.float64)
+    xsums = np.zeros(nextlabel, dtype=np.float64)
+    maxima = np.zeros(nextlabel, dtype=image.dtype)
+    minima = np.zeros(nextlabel, dtype=image.dtype)
+    numlabels = 0
+    for y in range(ydim):
+        if not stained[y]:
+            continue
+        for x in range(xdim):
+            root = labels[y, x]
+            if root == 0:
+                continue
+            while parent[root] != root:
+                root = parent[root]
+            if final[root] == 0:
+                numlabels += 1
+                final[root] = numlabels
+            current = final[root]
+            labels[y, x] = current
+            value = image[y, x]
+            if areas[current] == 0 or value > maxima[current]:
+                maxima[current] = value
+            if areas[current] == 0 or value < minima[current]:
+                minima[current] = value
+            areas[current] += 1
+            sums[current] += value
+            ysums[current] += y + yoffset
+            xsums[current] += x
+    end = numlabels + 1
+    return numlabels, areas[:end], sums[:end], ysums[:end], xsums[:end], maxima[:end], minima[:end]
+
+
+# Compiled version of a kernel, compiling it with numba the first time it's needed.
+def numbakernel(function):
+    if function not in compiledkernels:
+        import numba
+        compiledkernels[function] = numba.njit(cache=True, nogil=True)(function)
+    return compiledkernels[function]
+
+
+# Perimeter of the convex hull around a set of stain coordinates
+def hullarea(hullpoints):
+    from scipy.spatial import ConvexHull, qhull
+    if len(hullpoints) > 2:
         try:
-            hull = ConvexHull(coordlist)
-            arearesult = hull.area
+            vertices = hullpoints[ConvexHull(hullpoints).vertices]
         except (qhull.QhullError, ValueError):
             # Just in case staining forms a perfectly straight 2d line (area of 0)
-            arearesult = 0
-    else:
-        arearesult = 0
+            return 0
+        # Sum the edges exactly so the result doesn't depend on which interior points qhull was given.
+        edges = np.diff(vertices, axis=0, append=vertices[:1])
+        return math.fsum(np.hypot(edges[:, 0], edges[:, 1]))
+    return 0
+
+
+# Intensity histogram of an image, as the distinct pixel values present and the number of pixels with each.
+def histogram(inputimage):
+    if inputimage.dtype.kind == "u" and inputimage.dtype.itemsize <= 2:
+        counts = np.bincount(inputimage.ravel())
+        values = np.flatnonzero(counts)
+        return values.astype(inputimage.dtype), counts[values]
+    return np.unique(inputimage, return_counts=True)
+
+
+# Combine histograms of several parts of an image
+def mergehistograms(histograms):
+    values, inverse = np.unique(np.concatenate([values for values, counts in histograms]), return_inverse=True)
+    counts = np.zeros(len(values), dtype=np.int64)
+    np.add.at(counts, inverse, np.concatenate([counts for values, counts in histograms]))
+    return values, counts
+
+
+# Integrated intensity and positive pixel count after applying each threshold, as genstats would measure them.
+def sweepstats(values, counts, thresholds):
+    accumulator = sumtype(values.dtype)
+    counts = np.where(values == 0, 0, counts).astype(accumulator)  # Zero pixels never count as positive
+    # Totals for pixels at or above each value, with a zero entry for thresholds above the maximum.
+    end = np.zeros(1, dtype=accumulator)
+    positives = np.concatenate((np.cumsum(counts[::-1])[::-1], end))
+    intints = np.concatenate((np.cumsum((values.astype(accumulator) * counts)[::-1])[::-1], end))
+    index = np.searchsorted(values, thresholds, side='left')
+    return intints[index], positives[index].astype(np.int64)
+
+
+# Low memory equivalent of genstats, works through the image in bands of rows so only one band is held in memory.
+def tiledstats(reader, threshold, settings, file):
+    from scipy.ndimage import maximum_filter
+    from scipy.sparse import coo_matrix
+    from scipy.sparse.csgraph import connected_components
+    xdim, ydim = reader.xdim, reader.ydim
+    max_value = min_value = None
+    intint = count = 0
+    hullpoints = []  # Hull vertices of the staining in each band
+    bandstats = []  # Statistics for labels in each band, background excluded
+    peakpositions = []  # Flat positions of peak pixels in each band
+    peaklabels = []  # Label of each peak pixel
+    links = []  # Pairs of labels which touch across band boundaries
+    lastrow = None  # Labels in the last row of the previous band
+    numlabels = 0
+    thresholdedrange = None  # Maximum and minimum after thresholding, peaks aren't found in flat images
+    for y0, y1 in reader.bands():
+        # Read an extra row either side so peaks at the edge of a band see all their neighbours.
+        top, bottom = max(y0 - 1, 0), min(y1 + 1, ydim)
+        band = reader.read(top, bottom, reader.channel)
+        core = band[y0 - top:y1 - top]
+        bandmax, bandmin, bandint, bandcount, bandhull = thresholdstats(core, threshold, y0, settings.backend)
+        max_value = bandmax if max_value is None else max(max_value, bandmax)
+        min_value = bandmin if min_value is None else min(min_value, bandmin)
+        intint += bandint
+        count += bandcount
+        hullpoints.append(bandhull)
+        # Threshold the halo rows too, they're only used for finding peaks.
+        for halo in (band[:y0 - top], band[y1 - top:]):
+            halo[halo < threshold] = 0
+        if not settings.wantclusters:
+            continue
+        bandrange = (np.amax(core), np.amin(core))
+        if thresholdedrange is None:
+            thresholdedrange = bandrange
+        else:
+            thresholdedrange = (max(thresholdedrange[0], bandrange[0]), min(thresholdedrange[1], bandrange[1]))
+        bandlabels, bandnum, stats = labelclusters(core, y0, settings.backend)
+        bandstats.append([stat[1:] for stat in stats])
+        bandlabels[bandlabels > 0] += numlabels
+        if lastrow is not None:  # Link labels touching diagonally or directly across the boundary.
+            firstrow = bandlabels[0]
+            for above, below in ((lastrow, firstrow), (lastrow[1:], firstrow[:-1]), (lastrow[:-1], firstrow[1:])):
+                touching = (above > 0) & (below > 0)
+                links.append(np.stack((above[touching], below[touching])))
+        lastrow = bandlabels[-1]
+        # Peaks, ignoring the image border like peak_local_max.
+        peakmask = (band == maximum_filter(band, size=3, mode='nearest')) & (band > threshold)
+        peakmask = peakmask[y0 - top:y1 - top]
+        peakmask[:, [0, -1]] = False
+        if y0 == 0:
+            peakmask[0] = False
+        if y1 == ydim:
+            peakmask[-1] = False
+        peakys, peakxs = np.nonzero(peakmask)
+        peakpositions.append((peakys + y0) * xdim + peakxs)
+        peaklabels.append(bandlabels[peakys, peakxs])
+        numlabels += bandnum
+    arearesult = hullarea(np.concatenate(hullpoints))
     results_pack = (intint, count, max_value, min_value, arearesult)
-    if wantclusters:
-        cluster_results = getclusters(inputimage, threshold, app.minarea.get(), file)
+    clusterdata = []
+    if settings.wantclusters:
+        # Merge labels which continue across bands. Order clusters by their first label, as whole image labelling would.
+        links = np.concatenate(links, axis=1) if links else np.zeros((2, 0), dtype=int)
+        graph = coo_matrix((np.ones(links.shape[1]), (links[0], links[1])), shape=(numlabels + 1, numlabels + 1))
+        numclusters, groups = connected_components(graph, directed=False)
+        firstlabels = np.full(numclusters, numlabels + 1)
+        np.minimum.at(firstlabels, groups, np.arange(numlabels + 1))
+        order = np.empty(numclusters, dtype=int)
+        order[np.argsort(firstlabels)] = np.arange(numclusters)
+        clusterids = order[groups]  # Final cluster id of each label, background stays at 0.
+        stats = [np.concatenate([np.zeros(1, dtype=bandstats[0][i].dtype)] + [stat[i] for stat in bandstats])
+                 for i in range(6)]
+        areas, sums, ysums, xsums = (np.bincount(clusterids, weights=stat, minlength=numclusters) for stat in stats[:4])
+        maxima = np.zeros(numclusters, dtype=stats[4].dtype)
+        np.maximum.at(maxima, clusterids, stats[4])
+        minima = maxima.copy()
+        np.minimum.at(minima, clusterids, stats[5])
+        peakpositions = np.concatenate(peakpositions)
+        peaklabels = np.concatenate(peaklabels)[mergepeaks(peakpositions, xdim)]
+        peakcounts = np.bincount(clusterids[peaklabels], minlength=numclusters)
+        if thresholdedrange[0] == thresholdedrange[1]:
+            peakcounts[:] = 0
+        cluster_results, clusterdata = summariseclusters((areas, sums, ysums, xsums, maxima, minima), peakcounts,
+                                                         (ydim, xdim), settings, file)
         results_pack += cluster_results
-    return results_pack
+    return results_pack, clusterdata
 
 
 # Cluster Analysis
-def getclusters(trgtimg, threshold, minimumarea, file):
-    # Find and count peaks above threshold, assign labels to clusters of stainng.
+def getclusters(trgtimg, threshold, settings, file):
+    from skimage.feature import peak_local_max
+    # Assign labels to clusters of staining, then gather statistics for every cluster from the labelled pixels.
+    simpleclusters, numclusters, stats = labelclusters(trgtimg, 0, settings.backend)
+    # Find peaks above threshold and count them within each cluster.
+    xdim = trgtimg.shape[1]
     peaks = peak_local_max(trgtimg, threshold_abs=threshold)
-    localmax = np.zeros_like(trgtimg, dtype=bool)
-    localmax[tuple(peaks.T)] = True
-    peaks, numpeaks = label(localmax, return_num=True)
-    simpleclusters, numclusters = label(trgtimg > 0, return_num=True)
-    # Create table of cluster ids vs size of each, then list clusters bigger than minsize
-    areacounts = np.unique(simpleclusters, return_counts=True)
-    positivegroups = areacounts[0][1:][areacounts[1][1:] >= minimumarea]
-    # Mask for only positive clusters, find clusters which are in the list of clusters, count them.
-    clustermask = np.isin(simpleclusters, positivegroups)
-    targetclusters = np.sum(areacounts[1][1:] >= minimumarea)
-    # Clone the image then remove any staining in negative clusters. Quantifies staining in positive clusters.
-    filthresholded = trgtimg.copy()
-    filthresholded[np.invert(clustermask)] = 0
-    intintfil = np.sum(filthresholded)
-    countfil = np.count_nonzero(filthresholded)
-    peaks2 = peak_local_max(filthresholded[:, :], threshold_abs=threshold)
-    localmax2 = np.zeros_like(filthresholded[:, :], dtype=bool)
-    localmax2[tuple(peaks2.T)] = True
-
-    targetpeaks, numtargetpeaks = label(localmax2, return_num=True)
-    cprops = regionprops(simpleclusters, trgtimg)  # Get stats for each cluster
-    currentid = 0
-    clusterbuffer = []  # Store cluster data for writing in bulk
+    positions = np.sort(peaks[:, 0] * xdim + peaks[:, 1])
+    positions = positions[mergepeaks(positions, xdim)]
+    peaklabels = simpleclusters[positions // xdim, positions % xdim]
+    peakcounts = np.bincount(peaklabels, minlength=numclusters + 1)
+    return summariseclusters(stats, peakcounts, trgtimg.shape, settings, file)
+
+
+# Label clusters of staining (8-connected positive pixels) in raster order and gather their statistics. Returns the
+# labelled image, number of labels and the statistics from labelstats.
+def labelclusters(image, yoffset, backend):
+    if backend == "numba" and image.size:
+        # Labels never outnumber the pixels up to the end of the image, 32-bit labels halve the memory needed.
+        labeltype = np.int32 if (yoffset + image.shape[0]) * image.shape[1] < 2 ** 31 else np.intp
+        labels = np.zeros(image.shape, dtype=labeltype)
+        numlabels, areas, sums, ysums, xsums, maxima, minima = numbakernel(labelkernel)(image, yoffset, labels)
+        return labels, numlabels, (areas, sums, ysums, xsums, maxima, minima)
+    from skimage.measure import label
+    labels, numlabels = label(image > 0, return_num=True)
+    return labels, numlabels, labelstats(labels, image, numlabels, yoffset)
+
+
+# Area, sum, coordinate sums, maximum and minimum of each label in a labelled image, indexed by label.
+def labelstats(labelimage, image, numlabels, yoffset):
+    ycoords, xcoords = np.nonzero(labelimage)
+    pixellabels = labelimage[ycoords, xcoords]
+    pixelvalues = image[ycoords, xcoords]
+    areas = np.bincount(pixellabels, minlength=numlabels + 1)
+    sums = np.bincount(pixellabels, weights=pixelvalues, minlength=numlabels + 1)
+    ysums = np.bincount(pixellabels, weights=ycoords + yoffset, minlength=numlabels + 1)
+    xsums = np.bincount(pixellabels, weights=xcoords, minlength=numlabels + 1)
+    maxima = np.zeros(numlabels + 1, dtype=image.dtype)
+    np.maximum.at(maxima, pixellabels, pixelvalues)
+    minima = maxima.copy()
+    np.minimum.at(minima, pixellabels, pixelvalues)
+    return areas, sums, ysums, xsums, maxima, minima
+
+
+# Generate foci results from per-cluster statistics (index 0 is background).
+def summariseclusters(stats, peakcounts, imageshape, settings, file):
+    areas, sums, ysums, xsums, maxima, minima = stats
+    minimumarea = settings.minarea
+    numclusters = len(areas) - 1
+    numpeaks = int(np.sum(peakcounts))
+    # Clusters bigger than minsize, quantify staining and peaks within them.
+    positivegroups = np.flatnonzero(areas >= minimumarea)
+    positivegroups = positivegroups[positivegroups > 0]
+    targetclusters = len(positivegroups)
+    numtargetpeaks = int(np.sum(peakcounts[positivegroups]))
+    intintfil = sumtype(maxima.dtype)(np.sum(sums[positivegroups])).item()  # Float images keep their fraction
+    countfil = int(np.sum(areas[positivegroups]))
+    # Per-cluster stats, as floats to match regionprops.
+    focusareas = areas[positivegroups].astype(np.float64)
+    focusmeans = sums[positivegroups] / focusareas
+    clusterbuffer = [[file, currentid, (int(ysum // area), int(xsum // area)), area, float(maxvalue),
+                      float(minvalue), mean, area * mean]
+                     for currentid, (area, maxvalue, minvalue, mean, ysum, xsum) in
+                     enumerate(zip(focusareas.tolist(), maxima[positivegroups].tolist(),
+                                   minima[positivegroups].tolist(), focusmeans.tolist(),
+                                   ysums[positivegroups].tolist(), xsums[positivegroups].tolist()), start=1)]
     listcentroids = []  # Store centroids for calculating fluor50
     fluor50 = "N/A"  # Fallback f50 value for empty images
     returnpack = (numclusters, numpeaks, targetclusters, numtargetpeaks, intintfil, countfil)
-    for region in range(len(cprops)):
-        if cprops[region].area >= minimumarea:
-            currentid += 1
-            coord = tuple(int(x) for x in cprops[region].centroid)
-            resultpack = [file, currentid, coord, cprops[region].area, cprops[region].max_intensity,
-                          cprops[region].min_intensity, cprops[region].mean_intensity,
-                          cprops[region].area * cprops[region].mean_intensity]
-            clusterbuffer.append(resultpack)
     if len(clusterbuffer) > 0:  # Only bother trying to write if there's data
-        if app.wantfluor50.get():  # Arrange clusters by size
+        if settings.wantfluor50:  # Arrange clusters by size
             clusterbuffer.sort(reverse=True, key=lambda x: x[7])
             listintensities = list(zip(*clusterbuffer))[7]
             totalfluor = sum(listintensities)
@@ -1070,18 +2780,40 @@ def getclusters(trgtimg, threshold, minimumarea, file):
                 clusterbuffer[i][1] = i + 1  # Update id
                 clusterbuffer[i] = clusterbuffer[i] + [percentlist[i], cumulativelist[i], cumulativepercent[i]]
         listcentroids = list(zip(*clusterbuffer))[2]
-        if app.clustersave.get():
-            app.clusterwriter(clusterbuffer)
-    if app.wantfluor50.get():
+    if settings.wantfluor50:
         returnpack += (fluor50,)
-    if app.wantspatial.get():
-        spatials = runspatialanalysis(listcentroids, trgtimg.shape)
+    if settings.wantspatial:
+        with timed("runspatialanalysis"):
+            spatials = runspatialanalysis(listcentroids, imageshape, settings.gridboxsize, settings.extraboxsizes)
         returnpack += spatials
-    return returnpack
+    if not settings.clustersave:  # Only hand back per-focus data if it's going to be saved
+        clusterbuffer = []
+    return returnpack, clusterbuffer
+
+
+# Merge touching peak pixels (plateaus) into single peaks. Takes sorted flat positions, returns indexes to keep.
+def mergepeaks(positions, xdim):
+    from scipy.sparse import coo_matrix
+    from scipy.sparse.csgraph import connected_components
+    # Link each peak pixel to any peak pixel right of or below it. Border pixels are never peaks, so no wrapping.
+    links = []
+    for offset in (1, xdim - 1, xdim, xdim + 1):
+        neighbours = np.searchsorted(positions, positions + offset)
+        found = neighbours < len(positions)
+        found[found] = positions[neighbours[found]] == positions[found] + offset
+        links.append((np.flatnonzero(found), neighbours[found]))
+    sources = np.concatenate([link[0] for link in links])
+    if not len(sources):
+        return np.arange(len(positions))
+    targets = np.concatenate([link[1] for link in links])
+    graph = coo_matrix((np.ones(len(sources)), (sources, targets)), shape=(len(positions), len(positions)))
+    groups = connected_components(graph, directed=False)[1]
+    return np.unique(groups, return_index=True)[1]
 
 
 # Determine Fluor50 - clusters needed for 50% of all staining
 def getfluor50(cumpercentlist):
+    from scipy.interpolate import interp1d
     cumpercentlist = np.insert(cumpercentlist, 0, 0)  # Insert a point at 0
     ids = np.arange(0, len(cumpercentlist))
     curve = interp1d(cumpercentlist, ids, kind='linear')
@@ -1089,11 +2821,12 @@ def getfluor50(cumpercentlist):
     return fluor50val
 
 
-# Determine spatial measurements. Grid test, polygon area, max icd.
-def runspatialanalysis(pointlist, imageshape):
+# Determine spatial measurements. Grid test, polygon area, max icd. Grid test results for any extra box sizes follow.
+def runspatialanalysis(pointlist, imageshape, boxsize, extraboxsizes=()):
+    from scipy.spatial import distance
     ydim, xdim = imageshape
-    coordmap = mapcoords(pointlist, xdim, ydim)
-    positivegrid, totalgrid = gridtest(coordmap, xdim, ydim)
+    coords = np.asarray(pointlist, dtype=np.int64).reshape(-1, 2)
+    positivegrid, totalgrid = gridtest(coords, xdim, ydim, boxsize)
     if len(pointlist) > 2:
         chullarea, ifdmax = findconvexhull(pointlist)
     elif len(pointlist) == 2:  # Can't make polygon from 2 points.
@@ -1104,44 +2837,47 @@ def runspatialanalysis(pointlist, imageshape):
         chullarea = 0
         ifdmax = 0
     resultspack = (totalgrid, positivegrid, chullarea, ifdmax)
+    for extrasize in extraboxsizes:
+        positivegrid, totalgrid = gridtest(coords, xdim, ydim, extrasize)
+        resultspack += (totalgrid, positivegrid)
     return resultspack
 
 
-# Generate blank array same shape as original image and map the cluster centroids onto it
-def mapcoords(inputlist, xdim, ydim):
-    blankimage = np.zeros((ydim, xdim), dtype=bool)
-    for coord in inputlist:
-        y, x = coord
-        blankimage[y, x] = True
-    return blankimage
-
-
-# Divide the image into boxes and check for clusters within each
-def gridtest(inputarray, imxdim, imydim):
-    positivecount = 0
-    totalcount = 0
-    splitfactory = int(imydim / app.gridboxsize.get())
-    splitfactorx = int(imxdim / app.gridboxsize.get())
+# Divide the image into boxes and check for clusters within each. Boxes are split like np.array_split, so they're as
+# evenly sized as possible. Box indexes are worked out from the cluster coordinates directly.
+def gridtest(pointlist, imxdim, imydim, boxsize):
+    splitfactory = int(imydim / boxsize)
+    splitfactorx = int(imxdim / boxsize)
     if splitfactory < 1:
         splitfactory = 1
     if splitfactorx < 1:
         splitfactorx = 1
-    arraylist = np.array_split(inputarray, splitfactory, 0)
-    arraycatcher = []
-    for array in arraylist:
-        subarrays = np.array_split(array, splitfactorx, 1)
-        arraycatcher.append(subarrays)
-
-    for arrayset in arraycatcher:
-        for subarray in arrayset:
-            totalcount += 1
-            if np.max(subarray):
-                positivecount += 1
+    totalcount = splitfactory * splitfactorx
+    if len(pointlist) == 0:
+        return 0, totalcount
+    coords = np.asarray(pointlist, dtype=np.int64).reshape(-1, 2)
+    boxy = splitindex(coords[:, 0], imydim, splitfactory)
+    boxx = splitindex(coords[:, 1], imxdim, splitfactorx)
+    positivecount = len(np.unique(boxy * splitfactorx + boxx))
     return positivecount, totalcount
 
 
+# Box sizes from text such as "50, 100", ignoring anything which isn't a whole number above 0.
+def parseboxsizes(text):
+    boxsizes = [int(size) for size in text.replace(",", " ").split() if size.isdigit() and int(size) > 0]
+    return list(dict.fromkeys(boxsizes))
+
+
+# Section of np.array_split(range(length), sections) containing each position
+def splitindex(positions, length, sections):
+    size, extra = divmod(length, sections)
+    boundary = extra * (size + 1)  # The first extra sections are one longer than the rest.
+    return np.where(positions < boundary, positions // (size + 1), extra + (positions - boundary) // max(size, 1))
+
+
 # Generate a convex hull (polygon containing all coordinates)
 def findconvexhull(coords):
+    from scipy.spatial import ConvexHull, qhull, distance_matrix, distance
     # Add coords to array
     coordarray = np.array(coords)
     try:
@@ -1159,12 +2895,260 @@ def findconvexhull(coords):
     return arearesult, maxdist
 
 
+# Raised while rendering a preview which has been replaced by a newer one.
+class PreviewCancelled(Exception):
+    pass
+
+
+# Renders previews on a background thread so the UI stays responsive. Only the newest request is rendered: requests
+# made while another is rendering replace any still waiting, and results of replaced requests are thrown away. Renders
+# call checkstale() between steps, which raises PreviewCancelled once they've been replaced. Results are handed to
+# deliver (or errors to fail) on the UI thread.
+class PreviewRenderer:
+    def __init__(self, widget):
+        self.widget = widget  # Widget used to schedule checks for results on the UI thread
+        self.generation = 0  # Increases with each request, older requests are stale
+        self.request = None  # Newest request waiting to be rendered, as (generation, render, deliver, fail)
+        self.busy = False  # Is a request being rendered?
+        self.polling = False  # Are checks for results scheduled?
+        self.results = queue.Queue()
+        self.condition = threading.Condition()
+        self.thread = None
+
+    # Queue a render, replacing any waiting request and making the one running stale.
+    def submit(self, render, deliver, fail):
+        with self.condition:
+            self.generation += 1
+            self.request = (self.generation, render, deliver, fail)
+            self.condition.notify()
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.run, daemon=True)
+            self.thread.start()
+        if not self.polling:
+            self.polling = True
+            self.widget.after(previewpoll, self.poll)
+
+    # Drop any waiting request and throw away the results of the one running.
+    def cancel(self):
+        with self.condition:
+            self.generation += 1
+            self.request = None
+
+    def run(self):
+        while True:
+            with self.condition:
+                while self.request is None:
+                    self.condition.wait()
+                generation, render, deliver, fail = self.request
+                self.request = None
+                self.busy = True
+
+            def checkstale():
+                if generation != self.generation:
+                    raise PreviewCancelled
+
+            try:
+                self.results.put((generation, deliver, render(checkstale)))
+            except PreviewCancelled:
+                pass
+            except Exception as error:  # Keep the renderer running whatever goes wrong with one preview.
+                self.results.put((generation, fail, error))
+            finally:
+                with self.condition:
+                    self.busy = False
+
+    # Hand finished renders to the UI, checking again later while any are still to come.
+    def poll(self):
+        while True:
+            try:
+                generation, handler, result = self.results.get_nowait()
+            except queue.Empty:
+                break
+            if generation == self.generation:
+                handler(result)
+        with self.condition:
+            self.polling = self.busy or self.request is not None or not self.results.empty()
+        if self.polling:
+            self.widget.after(previewpoll, self.poll)
+
+
+# Image decoded for previewing, in the 8 bit display range and resized to fit the preview window.
+class PreviewImage:
+    def __init__(self, file, imagetype, channel, messages):
+        self.file = file
+        self.imagetype = imagetype
+        self.channel = channel
+        self.messages = messages  # Log messages from loading the image
+        self.maxvalue = 0  # Highest pixel value in the original image
+        self.imlrg = None  # Full size image
+        self.imsml = None  # Resized image
+        self.indexed = None  # Resized image with a palette, recoloured to show the threshold overlay
+        self.resizefactor = 1  # Factor the image was resized by
+
+
+# Load an image for previewing. Detects the bit depth into settings, which should be a snapshot of the UI's settings.
+def loadpreview(file, settings):
+    messages = []
+    imfile, imagetype, channel = open_file(file, settings, messages.append)
+    image = PreviewImage(file, imagetype, channel, messages)
+    if imagetype == "Invalid":
+        return image
+    image.maxvalue = np.amax(imfile)
+    bit_depth_detect(image.maxvalue, settings, messages.append)
+    # Reduce to 8-bit range, integer images can skip the float conversion as the multipliers are whole numbers.
+    if np.issubdtype(imfile.dtype, np.integer):
+        imfile = (imfile // int(settings.scalemultiplier)).astype('uint8')
+    else:
+        imfile = (imfile / settings.scalemultiplier).astype('uint8')
+    if imfile.shape[1] > 750:
+        image.resizefactor = 750 / imfile.shape[1]
+        # Bilinear filtering in PIL smooths like skimage's anti-aliased rescale but works on 8-bit data directly.
+        size = (750, int(np.round(imfile.shape[0] * image.resizefactor)))
+        imsml = np.asarray(Image.fromarray(imfile).resize(size, Image.Resampling.BILINEAR))
+    else:
+        imsml = imfile
+    image.imlrg = imfile  # Full size 256 array
+    image.imsml = imsml  # Scaled 256 array
+    image.indexed = Image.fromarray(imsml)
+    image.indexed.putpalette(overlaypalette(256))  # Switches the image to palette mode
+    return image
+
+
+# Memory held by a preview image.
+def previewbytes(image):
+    return sum(array.nbytes for array in (image.imlrg, image.imsml) if array is not None)
+
+
+# Preview images which have been viewed recently, so that going back to a file doesn't read it again. The least
+# recently used images are dropped once they take up more than the memory budget (in MB). Images can also be loaded
+# ahead of time on a background thread.
+class PreviewCache:
+    def __init__(self, budget):
+        self.budget = budget * 2 ** 20
+        self.images = OrderedDict()  # {key: PreviewImage}, least recently used first
+        self.loading = {}  # {key: Future} for images being loaded in the background
+        self.lock = threading.Lock()
+        self.loader = None  # Thread pool for loading images ahead of time, created when first needed
+
+    # Images are reused if the file hasn't changed and would be loaded the same way.
+    @staticmethod
+    def key(file, settings):
+        stat = os.stat(file)
+        return (os.path.abspath(file), stat.st_size, stat.st_mtime_ns, settings.channel, settings.depthlocked,
+                settings.tempdepthlock, settings.currentdepth, settings.scalemultiplier)
+
+    # Get the preview of a file, loading it if it isn't cached. Loading detects the bit depth into settings.
+    def get(self, file, settings):
+        key = self.key(file, settings)
+        with self.lock:
+            if key in self.images:
+                self.images.move_to_end(key)
+                return self.images[key]
+            job = self.loading.get(key)
+        if job is not None:
+            try:
+                return job.result()
+            except Exception:  # Load it again below to report the error.
+                pass
+        image = loadpreview(file, settings)
+        self.store(key, image)
+        return image
+
+    # Start loading previews of files which aren't already cached.
+    def prefetch(self, files, settings):
+        if self.loader is None:
+            self.loader = ThreadPoolExecutor(max_workers=1)
+        for file in files:
+            try:
+                key = self.key(file, settings)
+            except OSError:
+                continue
+            with self.lock:
+                if key in self.images or key in self.loading:
+                    continue
+                self.loading[key] = self.loader.submit(self.load, key, file, copy.copy(settings))
+
+    def load(self, key, file, settings):
+        try:
+            image = loadpreview(file, settings)
+            self.store(key, image)
+            return image
+        finally:
+            with self.lock:
+                self.loading.pop(key, None)
+
+    # Add an image, dropping the least recently used ones if over budget. The newest image is always kept.
+    def store(self, key, image):
+        with self.lock:
+            self.images[key] = image
+            self.images.move_to_end(key)
+            total = sum(previewbytes(cached) for cached in self.images.values())
+            while total > self.budget and len(self.images) > 1:
+                total -= previewbytes(self.images.popitem(last=False)[1])
+
+    def clear(self):
+        with self.lock:
+            self.images.clear()
+
+
+# Palette showing an 8-bit image in greyscale, with values above the threshold in light blue.
+def overlaypalette(threshold):
+    palette = np.repeat(np.arange(256, dtype=np.uint8)[:, np.newaxis], 3, axis=1)
+    palette[threshold + 1:] = positivecolour
+    return palette.tobytes()
+
+
+# Generate the foci preview overlay for an image, marking positive pixels and the foci which would be counted. Returns
+# None if foci aren't wanted, as the threshold overlay is drawn by switching the image's palette.
+def renderoverlay(image, threshold, wantclusters, minarea, checkstale):
+    if not wantclusters:
+        return None
+    return previewclusters(image, threshold, minarea, checkstale)
+
+
+# Mark positive pixels and foci above the minimum area on a preview image. Foci are found in the full size image, but
+# only the resized preview is painted, blending in each marking by how much of a preview pixel it covers. Labels are
+# 32-bit and no colour copies of the full size image are made, so large images can be previewed accurately.
+def previewclusters(image, threshold, minimumarea, checkstale):
+    from scipy.ndimage import label
+    imgarray = image.imlrg
+    labels, numlabels = label(imgarray >= max(threshold, 1), structure=np.ones((3, 3)), output=np.int32)
+    checkstale()
+    # Count focus areas a few rows at a time, bincount would otherwise make a 64-bit copy of the labels.
+    areas = np.zeros(numlabels + 1, dtype=np.int64)
+    step = max(chunkpixels // max(labels.shape[1], 1), 1)
+    for row in range(0, labels.shape[0], step):
+        areas += np.bincount(labels[row:row + step].ravel(), minlength=numlabels + 1)
+    keep = areas > minimumarea
+    keep[0] = False  # Background
+    focusmask = keep[labels]
+    del labels
+    checkstale()
+    positivemask = imgarray > threshold
+    positivemask &= ~focusmask
+    size = image.imsml.shape[::-1]
+    focus = coverage(focusmask, size)
+    positive = coverage(positivemask, size)
+    del focusmask, positivemask
+    grey = image.imsml[:, :, np.newaxis].astype(np.float32)
+    overlay = grey * (1 - focus - positive) + focus * focuscolour + positive * positivecolour
+    return np.clip(np.round(overlay), 0, 255).astype(np.uint8)
+
+
+# Fraction of each pixel covered by a mask once it's resized to (width, height), with a trailing axis for colours.
+def coverage(mask, size):
+    if mask.shape[::-1] == size:
+        return mask[:, :, np.newaxis].astype(np.float32)
+    resized = Image.fromarray(mask.view(np.uint8) * np.uint8(255)).resize(size, Image.Resampling.BILINEAR)
+    return np.asarray(resized, dtype=np.float32)[:, :, np.newaxis] / 255
+
+
 # Save the preview image
 def savepreview():
     try:
         previewsavename = tkfiledialog.asksaveasfile(mode="w", defaultextension=".tif",
                                                      title="Choose save location")
-        app.previewrgb.save(previewsavename.name)
+        app.previewrgb.convert('RGB').save(previewsavename.name)
         app.logevent("Preview Saved")
         previewsavename.close()
     except (NameError, OSError, PermissionError, IOError):
@@ -1180,11 +3164,7 @@ class PreviewWindow:
         style.configure('imgwindow.TLabel', anchor='center')
         self.previewwindow = ttk.Frame(self.master)
         self.previewtitle = ttk.Label(self.previewwindow, text=("..." + app.previewfile[-100:]))
-        if not app.imagetypefail:
-            self.previewpane = ttk.Label(self.previewwindow, style='imgwindow.TLabel', image=app.preview)
-            self.previewpane.image = app.preview
-        else:
-            self.previewpane = ttk.Label(self.previewwindow, style='imgwindow.TLabel', text="[Preview Not Available]")
+        self.previewpane = ttk.Label(self.previewwindow, style='imgwindow.TLabel', text="[Loading Preview]")
         self.previewpane.bind("<Motion>", self.hover_pixel)
         self.previewcontrols = ttk.Frame(self.previewwindow, borderwidth=2,
                                          relief=tk.GROOVE)  # Frame for preview controls.
@@ -1236,14 +3216,8 @@ class PreviewWindow:
         if not self.previewwindow:
             return
         if mode == "cluster":
-            try:
-                app.genpreview(app.previewfile, True, newfile)
-                self.previewpane.config(image=app.preview)
-                self.previewpane.image = app.preview
-            except (AttributeError, ValueError, TypeError, OSError, PermissionError, IOError, MemoryError):
-                app.logevent("Error generating preview file")
+            app.genpreview(True, newfile)
             self.overlaytoggle.state(['active'])
-            app.displayed = "clusters"
             return
         elif mode == "change":
             newfile = True
@@ -1289,11 +3263,10 @@ class PreviewWindow:
                 self.prevpreviewbutton.state(['!disabled'])
             app.previewfile = app.filelist[app.currentpreviewfile]
             self.previewtitle.config(text=("..." + app.previewfile[-100:]))
-        try:
-            app.genpreview(app.previewfile, False, newfile)
-        except (AttributeError, ValueError, TypeError, OSError, PermissionError, IOError, MemoryError):
-            app.logevent("Error generating preview file")
-            return
+        app.genpreview(False, newfile)
+
+    # Show the newest preview, growing the window to fit it if needed.
+    def display(self):
         if not app.imagetypefail:  # Only show preview if the image is the right type.
             self.previewpane.config(image=app.preview)
             self.previewpane.image = app.preview
@@ -1306,13 +3279,10 @@ class PreviewWindow:
         else:
             self.previewpane.config(image='', text="[Preview Not Available]")
             self.previewpane.image = None
-        app.displayed = "overlay"
-
-        # Get pixel intensity under the mouse pointer.
 
     # Switch between overlay and original image in preview
     def switchpreview(self, cluster):
-        if app.imagetypefail:
+        if app.imagetypefail or app.preview is None:
             return
         if not cluster or app.displayed == "clusters":
             if app.displayed == "original":
@@ -1331,10 +3301,10 @@ class PreviewWindow:
 
     # Get value of pixel the cursor is over.
     def hover_pixel(self, event):
-        if not app.imagetypefail:
-            ymax, xmax, axes = app.imsml.shape
+        if not app.imagetypefail and app.imsml is not None:
+            ymax, xmax = app.imsml.shape
             if event.y < ymax and event.x < xmax:
-                pixel = app.imsml[event.y - 2][event.x - 2][0]  # Correct for border around label.
+                pixel = app.imsml[event.y - 2][event.x - 2]  # Correct for border around label.
                 self.currpixel.set(pixel)
         else:
             self.currpixel.set(0)
@@ -1385,10 +3355,127 @@ class FileListWindow:
 # UI Initialiser
 def main():
     global app
+    if tk is None:
+        sys.exit("Tkinter is not available, use the command line options to run without the UI (see --help).")
     root = tk.Tk()
     app = CoreWindow(root)
     root.mainloop()
 
 
+# Command line interface, runs a batch without the UI.
+def cli(argv=None):
+    parser = argparse.ArgumentParser(prog="quantifish", description="QuantiFish - Zebrafish Image Analyser")
+    parser.add_argument("directory", nargs="?", help="directory containing .tif images to analyse")
+    parser.add_argument("-o", "--output", default="output.csv", help="main output file (default: output.csv)")
+    parser.add_argument("-t", "--threshold", type=int, default=60,
+                        help="minimum intensity to count, on the 0-256 display scale (default: 60)")
+    parser.add_argument("--bit-depth", choices=tuple(depthmap), help="bit depth of the images (default: detect)")
+    parser.add_argument("--filter", choices=("none", "greyscale", "rgb"), default="none",
+                        help="image type restriction (default: none)")
+    parser.add_argument("--channel", choices=("Detect", "Blue", "Green", "Red"), default="Detect",
+                        help="channel to analyse in RGB mode (default: Detect)")
+    parser.add_argument("--keyword", help="only analyse files containing this keyword")
+    parser.add_argument("--no-subdirectories", action="store_true", help="skip images in subdirectories")
+    parser.add_argument("--foci", action="store_true", help="analyse foci")
+    parser.add_argument("--min-size", type=int, default=1, help="minimum focus size (default: 1)")
+    parser.add_argument("--fluor50", action="store_true", help="calculate Fluor50 (with --foci)")
+    parser.add_argument("--spatial", action="store_true", help="run spatial analysis (with --foci)")
+    parser.add_argument("--box-size", type=int, nargs="+", default=[50], metavar="SIZE",
+                        help="grid analysis box size from %d to %d, give several to analyse each in one pass "
+                             "(default: 50)" % boxsizerange)
+    parser.add_argument("--foci-output", help="save data for each focus to this file (with --foci), use a .parquet "
+                                              "extension for Parquet output")
+    parser.add_argument("--sweep", nargs="?", type=int, const=1, metavar="STEP",
+                        help="measure every image at thresholds from 0 to 256 in steps of STEP (default: 1) in one "
+                             "pass, instead of a normal analysis at a single threshold")
+    parser.add_argument("--cache", metavar="FILE",
+                        help="reuse results for unchanged images from this cache file, and save new results to it")
+    parser.add_argument("--prescan", action="store_true",
+                        help="when auto detecting, find the bit depth from every image before analysis instead of "
+                             "from the first image analysed (maxima are kept in the --cache file if given)")
+    parser.add_argument("--timings", metavar="FILE",
+                        help="save the time and peak memory used by each stage of analysis for each image to this "
+                             "csv file, and summarise them at the end (slows analysis)")
+    parser.add_argument("-p", "--processes", type=int, default=1,
+                        help="number of images to analyse at once (default: 1)")
+    parser.add_argument("--prefetch", type=int, default=2, metavar="FILES",
+                        help="files to read ahead while analysing in a single process, 0 to disable (default: 2)")
+    parser.add_argument("--prefetch-memory", type=int, default=512, metavar="MB",
+                        help="memory limit for files read ahead (default: 512)")
+    parser.add_argument("--backend", choices=backends, default="numpy",
+                        help="run thresholding and foci labelling as compiled kernels with numba, which must be "
+                             "installed (default: numpy)")
+    parser.add_argument("--serve", metavar="[HOST:]PORT",
+                        help="hand images out to network workers connecting on this port instead of analysing them "
+                             "here, and assemble their results (listens on all interfaces unless HOST is given)")
+    parser.add_argument("--worker", metavar="HOST:PORT",
+                        help="run as a network worker for the coordinator at HOST:PORT instead, analysing -p images "
+                             "at once until the coordinator finishes (images must be at the same paths here)")
+    parser.add_argument("--key", default=os.environ.get("QUANTIFISH_KEY"),
+                        help="key that network workers use to connect to the coordinator (default: the "
+                             "QUANTIFISH_KEY environment variable, or a random key printed by --serve)")
+    parser.add_argument("--low-memory", nargs="?", type=int, const=lowmemoryrows, default=0, metavar="ROWS",
+                        help="analyse images in bands of ROWS rows (default: %d) to limit memory use" % lowmemoryrows)
+    args = parser.parse_args(argv)
+    authkey = args.key.encode() if args.key else None
+    if args.worker:
+        if not authkey:
+            parser.error("--worker requires the coordinator's --key")
+        try:
+            address = parseaddress(args.worker, "localhost")
+        except ValueError:
+            parser.error("worker address must be HOST:PORT")
+        try:
+            runworker(address, authkey, max(args.processes, 1))
+        except (OSError, AuthenticationError) as error:
+            print("Unable to work for the coordinator at %s:%d: %s" % (*address, error))
+            return 1
+        return 0
+    if args.directory is None:
+        parser.error("the directory argument is required")
+    serve = None
+    if args.serve:
+        try:
+            serve = parseaddress(args.serve, "")
+        except ValueError:
+            parser.error("serve address must be [HOST:]PORT")
+    if not os.path.isdir(args.directory):
+        parser.error("input directory not found: " + args.directory)
+    if not 0 <= args.threshold <= 256:
+        parser.error("threshold must be between 0 and 256")
+    if not all(boxsizerange[0] <= boxsize <= boxsizerange[1] for boxsize in args.box_size):
+        parser.error("box size must be between %d and %d" % boxsizerange)
+    if args.sweep is not None and args.sweep < 1:
+        parser.error("sweep step must be at least 1")
+    if args.sweep and args.foci:
+        parser.error("foci can't be analysed in a threshold sweep")
+    if args.sweep and (args.cache or args.timings):
+        parser.error("--cache and --timings can't be used with a threshold sweep")
+    if args.foci_output and args.foci_output.lower().endswith(".parquet") \
+            and importlib.util.find_spec("pyarrow") is None:
+        parser.error("Parquet output requires pyarrow to be installed (pip install pyarrow)")
+    if args.backend == "numba" and importlib.util.find_spec("numba") is None:
+        parser.error("the numba backend requires numba to be installed (pip install numba)")
+    boxsizes = list(dict.fromkeys(args.box_size))
+    settings = AnalysisSettings(threshold=args.threshold, filtermode=("none", "greyscale", "rgb").index(args.filter),
+                                channel=args.channel, subdirectories=not args.no_subdirectories,
+                                keyword=args.keyword, bitdepth=args.bit_depth, wantclusters=args.foci,
+                                minarea=max(args.min_size, 1), wantfluor50=args.fluor50, wantspatial=args.spatial,
+                                gridboxsize=boxsizes[0], extraboxsizes=boxsizes[1:],
+                                clustersave=args.foci_output is not None,
+                                workers=max(args.processes, 1), tilerows=max(args.low_memory, 0),
+                                prefetch=max(args.prefetch, 0), prefetchmemory=max(args.prefetch_memory, 0),
+                                prescan=args.prescan, backend=args.backend)
+    if args.sweep:
+        runsweep(args.directory, args.output, settings, range(0, 257, args.sweep), serve=serve, authkey=authkey)
+    else:
+        runbatch(args.directory, args.output, settings, args.foci_output, cachefile=args.cache,
+                 timingsfile=args.timings, serve=serve, authkey=authkey)
+    return 0
+
+
 if __name__ == "__main__":
+    multiprocessing.freeze_support()
+    if len(sys.argv) > 1:
+        sys.exit(cli())
     main()
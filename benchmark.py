@@ -0,0 +1,261 @@
+# QuantiFish - A tool for quantification of fluorescence in Zebrafish embryos.
+# Copyright(C) 2017-2024 David Stirling
+
+# Benchmark QuantiFish analysis stages on synthetic zebrafish-like images.
+# Usage example:
+#     python benchmark.py --size 2048 2048 --images 5 --depths 8 16 --rgb --foci 300 --radius 1 8
+#     python benchmark.py --startup
+#     python benchmark.py --backend numba --check-backend
+
+import argparse
+import copy
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+from PIL import Image
+from scipy.spatial import ConvexHull
+
+import QuantiFish as qf
+
+# Startup commands timed by --startup, each run in a fresh interpreter.
+startupcommands = (("import QuantiFish", ["-c", "import QuantiFish"]),
+                   ("quantifish --help", [qf.__file__, "--help"]))
+
+# Analysis stages timed for each image, in the order they run.
+stages = ("open_file", "genstats", "getclusters", "runspatialanalysis", "datawriter", "clusterwriter")
+
+
+# Generate a synthetic larva: dim autofluorescent body with bright foci of varying size, plus camera noise.
+def synthimage(rng, shape, depth, foci, radii):
+    ydim, xdim = shape
+    maxvalue = qf.depthmap["%d-bit" % depth][1] - 1
+    image = rng.normal(maxvalue * 0.02, maxvalue * 0.005, shape).astype(np.float32)
+    # Elongated body across the middle of the image.
+    yy = ((np.arange(ydim, dtype=np.float32) - ydim / 2) / (ydim * 0.2)) ** 2
+    xx = ((np.arange(xdim, dtype=np.float32) - xdim / 2) / (xdim * 0.45)) ** 2
+    body = (yy[:, np.newaxis] + xx[np.newaxis, :]) < 1
+    image[body] += maxvalue * 0.08
+    # Foci are placed within the body, sizes drawn uniformly from the requested radius range.
+    bodyy, bodyx = np.nonzero(body[::4, ::4])
+    picks = rng.integers(0, len(bodyy), foci)
+    for cy, cx, radius in zip(bodyy[picks] * 4, bodyx[picks] * 4, rng.uniform(radii[0], radii[1], foci)):
+        reach = int(np.ceil(radius * 3))
+        y0, y1 = max(cy - reach, 0), min(cy + reach + 1, ydim)
+        x0, x1 = max(cx - reach, 0), min(cx + reach + 1, xdim)
+        py = (np.arange(y0, y1) - cy)[:, np.newaxis] ** 2
+        px = (np.arange(x0, x1) - cx)[np.newaxis, :] ** 2
+        image[y0:y1, x0:x1] += rng.uniform(0.3, 0.9) * maxvalue * np.exp(-(py + px) / (2 * radius ** 2))
+    return np.clip(image, 0, maxvalue).astype(np.uint8 if depth == 8 else np.uint16)
+
+
+# Write the set of test images, returning their paths.
+def makeimages(directory, args):
+    rng = np.random.default_rng(args.seed)
+    files = []
+    kinds = [(depth, False) for depth in args.depths]
+    if args.rgb:
+        kinds.append((8, True))  # PIL can only write 8-bit RGB tiffs.
+    for depth, rgb in kinds:
+        for i in range(args.images):
+            image = synthimage(rng, args.size, depth, args.foci, args.radius)
+            if rgb:
+                colour = np.zeros((*image.shape, 3), dtype=np.uint8)
+                colour[:, :, 1] = image
+                image = colour
+            name = os.path.join(directory, "bench_%s%d_%03d.tif" % ("rgb" if rgb else "grey", depth, i))
+            Image.fromarray(image).save(name)
+            files.append((name, "RGB %d-bit" % depth if rgb else "%d-bit" % depth))
+    return files
+
+
+# Write rows to a sink and flush them to disk, so the writer stages time writing rather than buffering rows.
+def writeout(sink, rows):
+    sink.writerows(rows)
+    sink.flush()
+
+
+# Run each analysis stage on a file, returning time and peak memory for each.
+def runstages(file, settings, sinks, trace):
+    timings = {}
+
+    def stage(name, function, *args):
+        if trace:
+            tracemalloc.reset_peak()
+            start = tracemalloc.get_traced_memory()[0]
+        begin = time.perf_counter()
+        result = function(*args)
+        elapsed = time.perf_counter() - begin
+        peak = tracemalloc.get_traced_memory()[1] - start if trace else 0
+        timings[name] = (elapsed, peak)
+        return result
+
+    stagesettings = copy.copy(settings)
+    stagesettings.wantclusters = False
+    imagedata, imagetype, channel = stage("open_file", qf.open_file, file, settings, lambda message: None)
+    qf.bit_depth_detect(imagedata.max(), settings, lambda message: None)
+    thresh = settings.threshold * settings.scalemultiplier
+    results = stage("genstats", qf.genstats, imagedata, thresh, stagesettings, file)[0]
+    # genstats leaves a thresholded image behind for foci analysis.
+    clustersettings = copy.copy(settings)
+    clustersettings.wantspatial = False
+    clusterresults, clusterdata = stage("getclusters", qf.getclusters, imagedata, thresh, clustersettings, file)
+    centroids = [row[2] for row in clusterdata]
+    spatials = stage("runspatialanalysis", qf.runspatialanalysis, centroids, imagedata.shape, settings.gridboxsize)
+    stage("datawriter", writeout, sinks[0], [qf.datarow(file, results + clusterresults + spatials, settings, channel)])
+    stage("clusterwriter", writeout, sinks[1], clusterdata)
+    return timings
+
+
+# Compare the stain polygon area against a hull over every positive pixel, as QuantiFish originally measured it.
+def checkhull(file, settings):
+    imagedata = qf.open_file(file, settings, lambda message: None)[0]
+    qf.bit_depth_detect(imagedata.max(), settings, lambda message: None)
+    thresh = settings.threshold * settings.scalemultiplier
+    stagesettings = copy.copy(settings)
+    stagesettings.wantclusters = False
+    arearesult = qf.genstats(imagedata.copy(), thresh, stagesettings, file)[0][4]
+    coordlist = np.argwhere(imagedata >= thresh)
+    reference = ConvexHull(coordlist).area if len(coordlist) > 2 else 0
+    return arearesult, reference, np.isclose(arearesult, reference, rtol=1e-12, atol=0)
+
+
+# Compare full analysis of a file with the numpy backend against another backend, which should match exactly.
+def checkbackend(file, settings):
+    results = []
+    for backend in ("numpy", settings.backend):
+        backendsettings = copy.copy(settings)
+        backendsettings.backend = backend
+        results.append(repr(qf.analyse_file(file, backendsettings)))
+    return results[0] == results[1]
+
+
+# Time each startup command in a fresh interpreter, returning the fastest of several runs.
+def startuptimes(repeats):
+    times = {}
+    for name, command in startupcommands:
+        runs = []
+        for repeat in range(repeats):
+            begin = time.perf_counter()
+            subprocess.run([sys.executable] + command, check=True, stdout=subprocess.DEVNULL)
+            runs.append(time.perf_counter() - begin)
+        times[name] = min(runs)
+    return times
+
+
+# Summarise results per image kind
+def report(records, pixels):
+    print("%-12s %-20s %10s %10s %10s %12s" % ("Images", "Stage", "ms/image", "images/s", "MPix/s", "peak MB"))
+    for kind in dict.fromkeys(kind for kind, timings in records):
+        kindtimes = [timings for recordkind, timings in records if recordkind == kind]
+        for name in stages + ("total",):
+            if name == "total":
+                times = [sum(timings[s][0] for s in stages) for timings in kindtimes]
+                peaks = [max(timings[s][1] for s in stages) for timings in kindtimes]
+            else:
+                times = [timings[name][0] for timings in kindtimes]
+                peaks = [timings[name][1] for timings in kindtimes]
+            mean = sum(times) / len(times)
+            print("%-12s %-20s %10.1f %10.2f %10.1f %12.1f" % (kind, name, mean * 1000, 1 / mean if mean else 0,
+                                                                 pixels / 1e6 / mean if mean else 0,
+                                                                 max(peaks) / 2 ** 20))
+        print()
+
+
+# Benchmark entry point
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark QuantiFish analysis stages on synthetic images")
+    parser.add_argument("--size", type=int, nargs=2, default=(2048, 2048), metavar=("Y", "X"),
+                        help="image dimensions (default: 2048 2048)")
+    parser.add_argument("--images", type=int, default=3, help="images of each kind (default: 3)")
+    parser.add_argument("--depths", type=int, nargs="+", choices=(8, 10, 12, 16), default=(8, 12, 16),
+                        help="greyscale bit depths to generate (default: 8 12 16)")
+    parser.add_argument("--rgb", action="store_true", help="also generate 8-bit RGB images (data in green)")
+    parser.add_argument("--foci", type=int, default=200, help="foci per image (default: 200)")
+    parser.add_argument("--radius", type=float, nargs=2, default=(1.0, 6.0), metavar=("MIN", "MAX"),
+                        help="range of focus radii in pixels (default: 1 6)")
+    parser.add_argument("--threshold", type=int, default=60, help="display-scale threshold (default: 60)")
+    parser.add_argument("--min-size", type=int, default=5, help="minimum focus size (default: 5)")
+    parser.add_argument("--box-size", type=int, default=50, help="grid analysis box size (default: 50)")
+    parser.add_argument("--repeats", type=int, default=1, help="timed passes over the image set (default: 1)")
+    parser.add_argument("--no-memory", action="store_true", help="skip the peak memory pass")
+    parser.add_argument("--check-hull", action="store_true",
+                        help="check stain polygon areas against a hull of every positive pixel")
+    parser.add_argument("--backend", choices=qf.backends, default="numpy",
+                        help="analysis backend to benchmark (default: numpy)")
+    parser.add_argument("--check-backend", action="store_true",
+                        help="check full analysis results from --backend against the numpy backend")
+    parser.add_argument("--startup", action="store_true",
+                        help="time importing QuantiFish and starting the command line instead of analysis")
+    parser.add_argument("--startup-target", type=float, default=0.5, metavar="SECONDS",
+                        help="fail --startup if any command takes longer than this (default: 0.5)")
+    parser.add_argument("--seed", type=int, default=0, help="random seed for image generation (default: 0)")
+    parser.add_argument("--keep", metavar="DIR", help="write images and csv output here instead of a temp dir")
+    args = parser.parse_args(argv)
+
+    if args.startup:
+        failures = 0
+        for name, seconds in startuptimes(max(args.repeats, 5)).items():
+            passed = seconds <= args.startup_target
+            print("%-20s %8.1f ms  %s" % (name, seconds * 1000, "OK" if passed else "SLOW"))
+            failures += not passed
+        if failures:
+            print("%d commands slower than the %.2fs startup target" % (failures, args.startup_target))
+            return 1
+        return 0
+
+    with tempfile.TemporaryDirectory() as tempdir:
+        workdir = args.keep or tempdir
+        os.makedirs(workdir, exist_ok=True)
+        print("Generating images in", workdir)
+        files = makeimages(workdir, args)
+        records = []
+        failures = 0
+        template = qf.AnalysisSettings(threshold=args.threshold, wantclusters=True, minarea=args.min_size,
+                                       wantfluor50=True, wantspatial=True, gridboxsize=args.box_size, clustersave=True,
+                                       backend=args.backend)
+        with qf.CSVSink(os.path.join(workdir, "output.csv"), headings=qf.mainheadings(template)) as resultsink, \
+                qf.CSVSink(os.path.join(workdir, "foci.csv"), headings=qf.clusterheadings(template)) as clustersink, \
+                qf.CSVSink(os.devnull) as warmupsink:
+            sinks = (resultsink, clustersink)
+            warmed = set()  # Kinds of image analysed once already
+            for file, kind in files:
+                if kind not in warmed:
+                    # Untimed first pass over each kind of image, so lazy imports and compiling numba kernels for
+                    # the image's data type aren't counted against it.
+                    runstages(file, copy.copy(template), (warmupsink, warmupsink), False)
+                    warmed.add(kind)
+                settings = copy.copy(template)
+                timings = None
+                for repeat in range(args.repeats):
+                    passtimes = runstages(file, settings, sinks, False)
+                    if timings is None or sum(t for t, m in passtimes.values()) < sum(t for t, m in timings.values()):
+                        timings = passtimes
+                if not args.no_memory:
+                    tracemalloc.start()
+                    peaks = runstages(file, settings, sinks, True)
+                    tracemalloc.stop()
+                    timings = {name: (timings[name][0], peaks[name][1]) for name in stages}
+                records.append((kind, timings))
+                if args.check_hull:
+                    arearesult, reference, matched = checkhull(file, settings)
+                    print("%s stain polygon area %r, full hull %r: %s" % (os.path.basename(file), arearesult, reference,
+                                                                          "OK" if matched else "MISMATCH"))
+                    failures += not matched
+                if args.check_backend:
+                    matched = checkbackend(file, copy.copy(template))
+                    print("%s %s backend results: %s" % (os.path.basename(file), args.backend,
+                                                         "OK" if matched else "MISMATCH"))
+                    failures += not matched
+        report(records, args.size[0] * args.size[1])
+        if failures:
+            print("%d stain polygon area or backend mismatches" % failures)
+            return 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -14,7 +14,10 @@ else:
 
 setup(
     app=['QuantiFish.py'],
+    py_modules=['QuantiFish'],
+    entry_points={'console_scripts': ['quantifish = QuantiFish:cli']},
     options=OPTIONS,
     setup_requires=EXTRAS,
     install_requires=["scikit-image", "scipy", "pillow", "numpy"],
+    extras_require={"parquet": ["pyarrow"], "numba": ["numba"]},
 )
@@ -0,0 +1,8 @@
+# QuantiFish - A tool for quantification of fluorescence in Zebrafish embryos.
+# Copyright(C) 2017-2024 David Stirling
+
+import os
+import sys
+
+# QuantiFish is a single module in the repository root.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,55 @@
+# QuantiFish - A tool for quantification of fluorescence in Zebrafish embryos.
+# Copyright(C) 2017-2024 David Stirling
+
+import numpy as np
+import pytest
+from PIL import Image
+
+import QuantiFish as qf
+
+pytest.importorskip("numba")
+
+
+# Random image with sparse staining, in plateaus so that foci have ties and several peaks.
+def sparseimage(shape, dtype, seed):
+    rng = np.random.default_rng(seed)
+    image = rng.integers(0, 4, size=shape) * 60
+    image[rng.random(shape) < 0.6] = 0
+    return image.astype(dtype)
+
+
+images = {
+    "sparse 8-bit": sparseimage((60, 45), np.uint8, 1),
+    "sparse 16-bit": sparseimage((37, 80), np.uint16, 2),
+    "empty": np.zeros((20, 30), dtype=np.uint8),
+    "single row": sparseimage((1, 50), np.uint8, 3),
+    "single stained row": np.full((1, 12), 200, dtype=np.uint8),
+    "single column": sparseimage((40, 1), np.uint16, 4),
+}
+
+
+def makesettings(backend, tilerows=0):
+    return qf.AnalysisSettings(bitdepth="8-bit", wantclusters=True, minarea=2, wantfluor50=True, wantspatial=True,
+                               gridboxsize=7, clustersave=True, tilerows=tilerows, backend=backend)
+
+
+@pytest.mark.parametrize("threshold", [0, 100])
+@pytest.mark.parametrize("name", images)
+def test_genstats(name, threshold):
+    image = images[name]
+    expected = qf.genstats(image, threshold, makesettings("numpy"), name)
+    assert repr(qf.genstats(image, threshold, makesettings("numba"), name)) == repr(expected)
+
+
+@pytest.mark.parametrize("tilerows", [1, 7, 1024])
+@pytest.mark.parametrize("threshold", [0, 100])
+@pytest.mark.parametrize("name", images)
+def test_tiledstats(name, threshold, tilerows, tmp_path):
+    filepath = str(tmp_path / "image.tif")
+    Image.fromarray(images[name]).save(filepath)
+    results = []
+    for backend in qf.backends:
+        settings = makesettings(backend, tilerows)
+        reader = qf.open_reader(filepath, settings, lambda message: None)[0]
+        results.append(repr(qf.tiledstats(reader, threshold, settings, name)))
+    assert results[1] == results[0]
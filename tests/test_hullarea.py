@@ -0,0 +1,65 @@
+# QuantiFish - A tool for quantification of fluorescence in Zebrafish embryos.
+# Copyright(C) 2017-2024 David Stirling
+
+import numpy as np
+import pytest
+from scipy.spatial import ConvexHull, QhullError
+
+import QuantiFish as qf
+
+
+# Stain polygon area as QuantiFish originally measured it, from a hull around every positive pixel.
+def fullhullarea(mask):
+    coordlist = np.argwhere(mask)
+    if len(coordlist) < 3:
+        return 0
+    try:
+        return ConvexHull(coordlist).area
+    except QhullError:  # Positive pixels in a straight line
+        return 0
+
+
+# Stain polygon area from the per-row extrema gathered while thresholding, as genstats measures it.
+def polygonarea(mask):
+    image = mask.astype(np.uint16) * 200
+    hullpoints = qf.thresholdstats(image, 100, 0)[-1]
+    return qf.hullarea(hullpoints)
+
+
+masks = {
+    "empty": np.zeros((8, 8), dtype=bool),
+    "single pixel": np.pad(np.ones((1, 1), dtype=bool), 3),
+    "two pixels": np.array([[1, 0, 0], [0, 0, 0], [0, 0, 1]], dtype=bool),
+    "single row": np.pad(np.ones((1, 9), dtype=bool), 2),
+    "single column": np.pad(np.ones((9, 1), dtype=bool), 2),
+    "broken row": np.array([[0, 1, 0, 0, 1, 1, 0, 1]], dtype=bool),
+    "diagonal": np.eye(7, dtype=bool),
+    "anti-diagonal": np.fliplr(np.eye(7, dtype=bool)),
+    "steep line": np.kron(np.eye(4, dtype=bool), np.ones((3, 1), dtype=bool)),
+    "square": np.pad(np.ones((5, 5), dtype=bool), 2),
+    "ring": np.pad(np.pad(np.zeros((3, 3), dtype=bool), 1, constant_values=True), 2),
+    "full image": np.ones((6, 4), dtype=bool),
+}
+
+
+@pytest.mark.parametrize("name", masks)
+def test_edge_cases(name):
+    mask = masks[name]
+    assert polygonarea(mask) == pytest.approx(fullhullarea(mask), rel=1e-12, abs=0)
+
+
+@pytest.mark.parametrize("seed", range(40))
+def test_random_masks(seed):
+    rng = np.random.default_rng(seed)
+    shape = rng.integers(1, 60, 2)
+    mask = rng.random(shape) < rng.uniform(0.001, 0.5)
+    assert polygonarea(mask) == pytest.approx(fullhullarea(mask), rel=1e-12, abs=0)
+
+
+# Hull points are gathered in chunks of rows, masks taller than a chunk must give the same area.
+@pytest.mark.parametrize("seed", range(10))
+def test_chunked_masks(seed, monkeypatch):
+    monkeypatch.setattr(qf, "chunkpixels", 64)
+    rng = np.random.default_rng(seed)
+    mask = rng.random((90, 30)) < 0.02
+    assert polygonarea(mask) == pytest.approx(fullhullarea(mask), rel=1e-12, abs=0)
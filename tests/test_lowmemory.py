@@ -0,0 +1,53 @@
+# QuantiFish - A tool for quantification of fluorescence in Zebrafish embryos.
+# Copyright(C) 2017-2024 David Stirling
+
+import struct
+
+import numpy as np
+from PIL import Image
+
+import QuantiFish as qf
+
+
+# Write an uncompressed 8-bit greyscale tiff as a sparse file, with the given pixels set. {(y, x): value}
+def sparsetiff(filepath, xdim, ydim, pixels):
+    tags = [(256, 4, xdim), (257, 4, ydim), (258, 3, 8), (259, 3, 1), (262, 3, 1), (273, 4, 256), (277, 3, 1),
+            (278, 4, ydim), (279, 4, xdim * ydim)]
+    with open(filepath, "wb") as file:
+        file.write(b"II*\x00" + struct.pack("<I", 8) + struct.pack("<H", len(tags)))
+        for tag, tagtype, value in tags:
+            file.write(struct.pack("<HHI", tag, tagtype, 1) + struct.pack("<H2x" if tagtype == 3 else "<I", value))
+        file.write(struct.pack("<I", 0))
+        for (y, x), value in pixels.items():
+            file.seek(256 + y * xdim + x)
+            file.write(bytes([value]))
+        file.truncate(256 + xdim * ydim)
+
+
+# Images over Pillow's decompression bomb limit are still memory-mapped and analysed in bands.
+def test_huge_tiff(tmp_path):
+    xdim, ydim = 16000, 12000
+    assert xdim * ydim > 2 * Image.MAX_IMAGE_PIXELS
+    pixels = {(10, 20): 200, (10, 21): 150, (6000, 8000): 90, (11999, 15999): 255}
+    filepath = str(tmp_path / "huge.tif")
+    sparsetiff(filepath, xdim, ydim, pixels)
+    assert qf.imagemode(filepath) == "L"
+    settings = qf.AnalysisSettings(bitdepth="8-bit", tilerows=4096)
+    reader, imagetype, channel, messages = qf.load_file(filepath, settings)
+    assert (imagetype, channel) == ("greyscale", "Grey")
+    assert reader.tiles
+    results = qf.tiledstats(reader, 100, settings, filepath)[0]
+    assert results[:4] == (605, 3, 255, 0)
+
+
+# Images over the limit which would have to be decoded in full are skipped as invalid.
+def test_decompression_bomb(tmp_path, monkeypatch):
+    filepath = str(tmp_path / "compressed.tif")
+    Image.fromarray(np.zeros((100, 100), dtype=np.uint8)).save(filepath, compression="tiff_lzw")
+    monkeypatch.setattr(Image, "MAX_IMAGE_PIXELS", 1000)
+    assert qf.imagemode(filepath) == "L"
+    for tilerows in (0, 16):
+        settings = qf.AnalysisSettings(bitdepth="8-bit", tilerows=tilerows)
+        imagetype = qf.load_file(filepath, settings)[1]
+        assert imagetype == "Invalid"
+        assert qf.filemaximum(filepath, settings) is None